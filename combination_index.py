@@ -0,0 +1,151 @@
+import json
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+SUMMARY_PATH = 'female_male_summary_fixed_1.csv'
+NUTRITION_TABLE_PATH = 'nutrition_table.csv'
+
+# Items per combination (large, small 1, small 2), and bits per packed item position.  Position 0 is an empty slot
+MAX_SLOTS = 3
+SLOT_BITS = 21
+EMPTY = -1
+
+# Rows read at a time by CombinationIndex.from_csv
+CHUNK_SIZE = 500_000
+
+
+def parse_combinations(combinations: pd.Series) -> np.ndarray:
+    """
+    @param combinations: 'Combination' column of the summary table (JSON lists of item pks)
+    @return: (N, MAX_SLOTS) array of item pks, EMPTY where a combination has fewer items
+    """
+    combinations = combinations.fillna('[]')
+    lengths = (combinations.str.count(',') + 1).to_numpy() * (combinations.str.len().to_numpy() > 2)
+    if len(lengths) and lengths.max() > MAX_SLOTS:
+        raise ValueError(f'Combinations have more than {MAX_SLOTS} items')
+    # Every pk of every row, parsed at once, then scattered to the rows' slots in order
+    flat = np.array(' '.join(combinations.tolist()).translate(str.maketrans('[],', '   ')).split(), dtype=np.int64)
+    pks = np.full((len(lengths), MAX_SLOTS), EMPTY, dtype=np.int64)
+    pks[np.arange(MAX_SLOTS) < lengths[:, None]] = flat
+    return pks
+
+
+def pack(positions: np.ndarray) -> np.ndarray:
+    """
+    @param positions: (N, MAX_SLOTS) item positions (1-based, 0 for an empty slot)
+    @return: (N,) int64 keys
+    """
+    keys = np.zeros(len(positions), dtype=np.int64)
+    for slot in range(MAX_SLOTS):
+        keys = (keys << SLOT_BITS) | positions[:, slot]
+    return keys
+
+
+def unpack(keys: np.ndarray) -> np.ndarray:
+    """
+    @param keys: (N,) keys made by pack
+    @return: (N, MAX_SLOTS) item positions
+    """
+    shifts = SLOT_BITS * np.arange(MAX_SLOTS - 1, -1, -1)
+    return (keys[:, None] >> shifts) & ((1 << SLOT_BITS) - 1)
+
+
+def load_names(path: str = NUTRITION_TABLE_PATH) -> dict:
+    """
+    @return: dict of item pk -> name
+    """
+    df_item = pd.read_csv(path, usecols=['pk', 'name'])
+    return dict(zip(df_item['pk'], df_item['name']))
+
+
+class CombinationIndex:
+    def __init__(self, pks: np.ndarray, names: Optional[dict] = None):
+        """
+        Frequency index of the combinations of the summary table, replacing the notebook's value_counts over the JSON
+        strings.  Items are mapped to positions, each combination is packed into one int64 key (SLOT_BITS per item) and
+        the keys are counted once with np.unique; item counts are then bincounts over the distinct combinations.  Names
+        are only looked up for the rows a query returns.
+        @param pks: (N, MAX_SLOTS) item pks of the combinations, see parse_combinations
+        @param names: dict of item pk -> name, see load_names.  Without it, the name columns are left out
+        """
+        pks = np.asarray(pks, dtype=np.int64).reshape(-1, MAX_SLOTS)
+        filled = pks != EMPTY
+        # Item pks by position - 1
+        self.items, inverse = np.unique(pks[filled], return_inverse=True)
+        if len(self.items) >= 1 << SLOT_BITS:
+            raise ValueError(f'Too many items to pack: {len(self.items)}')
+        positions = np.zeros(pks.shape, dtype=np.int64)
+        positions[filled] = inverse + 1
+
+        self.keys, self.counts = np.unique(pack(positions), return_counts=True)
+        self.num_rows = len(pks)
+        self.names = names
+
+    @classmethod
+    def from_csv(cls, path: str = SUMMARY_PATH, names: Optional[dict] = None,
+                 chunk_size: int = CHUNK_SIZE) -> 'CombinationIndex':
+        """
+        Builds the index from a summary CSV, reading only its 'Combination' column, in chunks
+        @param path: Path to the CSV
+        @param names: See __init__
+        @param chunk_size: Rows per chunk
+        @return: The index
+        """
+        chunks = pd.read_csv(path, usecols=['Combination'], chunksize=chunk_size)
+        pks = [parse_combinations(chunk['Combination']) for chunk in chunks]
+        return cls(np.concatenate(pks) if pks else np.zeros((0, MAX_SLOTS), dtype=np.int64), names)
+
+    def _pks(self, positions: np.ndarray) -> list[list[int]]:
+        return [[int(self.items[position - 1]) for position in row if position] for row in positions]
+
+    def count(self, combination: list[int]) -> int:
+        """
+        @param combination: Item pks of a combination, in slot order
+        @return: Number of rows with that combination
+        """
+        if len(combination) > MAX_SLOTS:
+            return 0
+        pks = np.asarray(combination, dtype=np.int64)
+        found = np.searchsorted(self.items, pks)
+        if np.any(found >= len(self.items)) or np.any(self.items[np.minimum(found, len(self.items) - 1)] != pks):
+            return 0
+        positions = np.zeros((1, MAX_SLOTS), dtype=np.int64)
+        positions[0, :len(combination)] = found + 1
+        key = pack(positions)[0]
+        idx = np.searchsorted(self.keys, key)
+        return int(self.counts[idx]) if idx < len(self.keys) and self.keys[idx] == key else 0
+
+    def top_combinations(self, k: Optional[int] = None) -> pd.DataFrame:
+        """
+        Most frequent combinations (table_1_combo_freq of the notebook)
+        @param k: Number of combinations, None for all of them
+        @return: DataFrame indexed by the combination (JSON list of pks), with 'Count' and 'Combination_Name' columns,
+        most frequent first
+        """
+        order = np.argsort(-self.counts, kind='stable')[:k]
+        combinations = self._pks(unpack(self.keys[order]))
+        df_combos = pd.DataFrame({'Count': self.counts[order]},
+                                 index=pd.Index([json.dumps(pks) for pks in combinations], name='Combination'))
+        if self.names is not None:
+            df_combos['Combination_Name'] = [json.dumps([self.names[pk] for pk in pks]) for pks in combinations]
+        return df_combos
+
+    def item_counts(self, slot: Optional[int] = None, k: Optional[int] = None) -> pd.DataFrame:
+        """
+        Number of rows each item appears in (table_2_item_freq of the notebook)
+        @param slot: Only count the items in that slot (0 for the large section), None for all slots
+        @param k: Number of items, None for all of them
+        @return: DataFrame indexed by item pk, with 'Count' and 'Item_Name' columns, most frequent first
+        """
+        positions = unpack(self.keys)
+        positions = positions if slot is None else positions[:, [slot]]
+        counts = np.bincount(positions.ravel(), weights=np.repeat(self.counts, positions.shape[1]),
+                             minlength=len(self.items) + 1)[1:].astype(np.int64)
+        order = np.argsort(-counts, kind='stable')
+        order = order[counts[order] > 0][:k]
+        df_items = pd.DataFrame({'Count': counts[order]}, index=pd.Index(self.items[order], name='pk'))
+        if self.names is not None:
+            df_items['Item_Name'] = [self.names[pk] for pk in df_items.index]
+        return df_items
@@ -0,0 +1,135 @@
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from common import NUTRITION_FIELDS
+from item_choice import PlateSection, best_combination, section_categories
+from cost import Coefficients, nutrition_vector
+from lattice import DEFAULT_GRID_SIZE, lattice_solve, section_arrays
+from portion import MealItemSpec, PlateSectionState
+from requirements import nutritional_info_for, StudentProfileSpec
+
+# Requirements are rounded to this many significant digits when looking for profiles that can share a run
+REQUIREMENT_DIGITS = 3
+# Number of triples handed to lattice_solve at once
+TRIPLE_BLOCK = 2 ** 16
+
+
+class BatchMealItemSelector:
+    def __init__(self, profiles: list[StudentProfileSpec], items: list[MealItemSpec],
+                 large_portion_max: float, small_portion_max: float,
+                 coefficients: Coefficients, grid_size: int = DEFAULT_GRID_SIZE, refine_rounds: int = 0,
+                 requirement_digits: int = REQUIREMENT_DIGITS):
+        """
+        Runs the item selection for many students at once on the same menu.  The nutrition of every item at every
+        candidate volume does not depend on the student, so it is computed once; the costs of every triple for every
+        (distinct) student are then evaluated as one broadcasted tensor.
+
+        Portions are chosen by lattice.lattice_solve instead of by simulated annealing, which makes the costs
+        deterministic and cheap to broadcast.
+
+        Students whose large plate section holds the same category and whose requirements agree up to
+        requirement_digits significant digits are deduplicated, and share one result.
+        @param profiles: Students to choose for
+        @param items: A list of MealItemSpec, which represent the list of meal items available at the meal
+        @param large_portion_max: Size of the large plate section (mL)
+        @param small_portion_max: Size of the small plate sections (mL)
+        @param coefficients: Weights denoting how much each nutrient is weighted, see cost.coefficient_vector
+        @param grid_size: Number of volumes tried per plate section
+        @param refine_rounds: Number of lattice refinement rounds, see lattice.lattice_solve
+        @param requirement_digits: Significant digits used when comparing requirements for deduplication
+        """
+        self.profiles = profiles
+        self.items = items
+
+        self.coefficients = coefficients
+        self.grid_size = grid_size
+        self.refine_rounds = refine_rounds
+        self.requirement_digits = requirement_digits
+        self.large_portion_max = large_portion_max
+        self.small_portion_max = small_portion_max
+
+        self.requirements = [nutritional_info_for(profile) for profile in profiles]
+        self.num_distinct = -1
+        self._result_objs = [{} for _ in profiles]
+        self.result_costs = [-1.] * len(profiles)
+        self.runtime = -1
+        self.done = False
+
+    def _requirement_key(self, lo, hi) -> tuple:
+        digits = self.requirement_digits
+        return tuple(float(f'{v:.{digits}g}') for v in np.concatenate((nutrition_vector(lo), nutrition_vector(hi))))
+
+    def _lattice_costs(self, large, small1, small2, lo, hi):
+        """
+        Costs of every triple for every requirement, each minimized over the volume lattice
+        @param large: section_arrays of the large items, with the section axis dropped
+        @param small1: Same for small1
+        @param small2: Same for small2
+        @param lo: (G, 16) lower requirement bounds
+        @param hi: (G, 16) upper requirement bounds
+        @return: (G, L, S1, S2) costs
+        """
+        shape = (len(large[0]), len(small1[0]), len(small2[0]))
+        costs = np.empty((len(lo), int(np.prod(shape))))
+        for start in range(0, costs.shape[1], TRIPLE_BLOCK):
+            idx = np.unravel_index(np.arange(start, min(start + TRIPLE_BLOCK, costs.shape[1])), shape)
+            arrays = (np.stack([section[a][i] for section, i in zip((large, small1, small2), idx)], axis=1)
+                      for a in range(4))
+            costs[:, start:start + len(idx[0])], _ = lattice_solve(*arrays, lo, hi, self.coefficients,
+                                                                   self.grid_size, self.refine_rounds)
+        return costs.reshape((len(lo),) + shape)
+
+    def run_algorithm(self):
+        start_time = time.perf_counter()
+        # Group students by plate layout, then by (rounded) requirements
+        groups = defaultdict(lambda: defaultdict(list))
+        for idx, (profile, (lo, hi)) in enumerate(zip(self.profiles, self.requirements)):
+            layout = section_categories(profile.health_goal, self.large_portion_max)
+            groups[layout][self._requirement_key(lo, hi)].append(idx)
+        self.num_distinct = sum(len(by_req) for by_req in groups.values())
+
+        section_nutrition = {}
+
+        def nutrition_for(category, container_volume):
+            key = category, container_volume
+            if key not in section_nutrition:
+                cat_items = [item for item in self.items if item.category == category]
+                arrays = section_arrays([[PlateSectionState.from_item_spec(item, container_volume, 1, '')]
+                                         for item in cat_items], n=1)
+                section_nutrition[key] = cat_items, tuple(a[:, 0] for a in arrays)
+            return section_nutrition[key]
+
+        for layout, by_req in groups.items():
+            (large_items, large), (small1_items, small1), (small2_items, small2) = (
+                nutrition_for(category, volume) for category, volume in
+                zip(layout, (self.large_portion_max, self.small_portion_max, self.small_portion_max)))
+            members = list(by_req.values())
+            lo, hi = (np.array([nutrition_vector(self.requirements[idxs[0]][side]) for idxs in members])
+                      .reshape(len(members), len(NUTRITION_FIELDS)) for side in (0, 1))
+            costs = self._lattice_costs(large, small1, small2, lo, hi)
+
+            for group_costs, idxs in zip(costs, members):
+                pos_l, pos_s1, pos_s2, best_cost = best_combination(group_costs)
+                result = {
+                    section: {
+                        'items': [section_items[p].id for p in positions],
+                        'category': category
+                    }
+                    for section, section_items, positions, category in zip(
+                        PlateSection.all(), (large_items, small1_items, small2_items), (pos_l, pos_s1, pos_s2), layout)
+                }
+                for idx in idxs:
+                    self._result_objs[idx] = result
+                    self.result_costs[idx] = best_cost
+
+        self.runtime = time.perf_counter() - start_time
+        self.done = True
+
+    def result_obj(self, index: int):
+        """
+        @param index: Position of the student in the profiles list
+        @return: The result of that student, in the same format as MealItemSelector.result_obj()
+        """
+        return self._result_objs[index]
@@ -0,0 +1,75 @@
+import csv
+from dataclasses import fields
+
+import numpy as np
+
+from common import NUTRITION_FIELDS
+from portion import MealItemSpec
+
+# Default location of the item table, relative to this directory
+NUTRITION_TABLE_PATH = '../nutrition_table.csv'
+
+
+def _parse(value, kind):
+    """
+    Converts a raw CSV cell to the type of a MealItemSpec field (empty numeric cells become 0)
+    """
+    if kind is str or isinstance(value, kind):
+        return value
+    if value == '' or value is None:
+        return kind()
+    return kind(float(value)) if kind is int else kind(value)
+
+
+def mealitemspec_from_dict(d):
+    """
+    Creates a MealItemSpec from a row of nutrition_table.csv (pk becomes the id, unknown columns are ignored)
+    @param d: Row of the table, as a dict
+    @return: The MealItemSpec
+    """
+    dd = {'id': _parse(d['pk'], int)}
+    for field in fields(MealItemSpec):
+        if field.name in d and field.name != 'id':
+            dd[field.name] = _parse(d[field.name], field.type)
+    return MealItemSpec(**dd)
+
+
+def load_items(path: str = NUTRITION_TABLE_PATH) -> list[MealItemSpec]:
+    """
+    Loads every item of the nutrition table
+    @param path: Path to nutrition_table.csv
+    @return: List of MealItemSpec, in table order
+    """
+    with open(path) as f:
+        return list(map(mealitemspec_from_dict, csv.DictReader(f)))
+
+
+def nutrition_matrix(items: list[MealItemSpec]) -> np.ndarray:
+    """
+    Stacks the nutrition facts of the items into a matrix
+    @param items: Items to stack
+    @return: (len(items), 16) float array, columns are in NUTRITION_FIELDS order
+    """
+    return np.array([[float(getattr(item, name)) for name in NUTRITION_FIELDS] for item in items],
+                    dtype=np.float64).reshape(len(items), len(NUTRITION_FIELDS))
+
+
+def nutritional_signature(item: MealItemSpec) -> tuple:
+    """
+    @return: Every field of the item that the algorithm looks at, i.e. all of them but id and cafeteria_id
+    """
+    return tuple(getattr(item, field.name) for field in fields(MealItemSpec)
+                 if field.name not in ('id', 'cafeteria_id'))
+
+
+def identical_groups(items: list[MealItemSpec]) -> list[list[MealItemSpec]]:
+    """
+    Groups items with the same nutritional_signature (the table has many copies of the same dish under different pks
+    and cafeterias)
+    @param items: Items to group
+    @return: List of groups, groups and their items are in order of first appearance
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(nutritional_signature(item), []).append(item)
+    return list(groups.values())
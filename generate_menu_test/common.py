@@ -25,6 +25,8 @@ LUNCH = 'lunch'
 AFT_SNACK = 'afternoon_snack'
 DINNER = 'dinner'
 EVE_SNACK = 'evening_snack'
+# Main meals, in the order they are eaten
+MEALS = (BREAKFAST, LUNCH, DINNER)
 
 # Category (of food)
 VEGETABLE = 'vegetable'
@@ -196,3 +198,20 @@ class Nutrition:
         ret = self.copy()
         ret /= c
         return ret
+
+
+# Nutrient names, in the same order as the fields of Nutrition (i.e. the column order of any nutrition matrix)
+NUTRITION_FIELDS = tuple(prop.name for prop in fields(Nutrition))
+
+# Plate score of Analysis.ipynb: points for each nutrient in range.  Calories count both on their own and as a macro
+CAL_WEIGHT = 4
+MACRO_NUTRIENTS = ('protein', 'carbohydrate', 'calories', 'total_fat', 'saturated_fat')
+MICRO_NUTRIENTS = ('sodium', 'calcium', 'iron', 'vitamin_a', 'vitamin_c', 'vitamin_d', 'sugar', 'cholesterol', 'fiber',
+                   'potassium')
+MACRO_WEIGHT = 6 / len(MACRO_NUTRIENTS)
+MICRO_WEIGHT = 3 / len(MICRO_NUTRIENTS)
+# Points of each nutrient, in NUTRITION_FIELDS order
+SCORE_WEIGHTS = tuple((CAL_WEIGHT if name == 'calories' else 0) + (MACRO_WEIGHT if name in MACRO_NUTRIENTS else 0) +
+                      (MICRO_WEIGHT if name in MICRO_NUTRIENTS else 0) for name in NUTRITION_FIELDS)
+# Min score of a valid combination
+VALID_COMBINATION_SCORE = 7.9
@@ -0,0 +1,73 @@
+from typing import Sequence, Union
+
+import numpy as np
+
+from common import Nutrition, NUTRITION_FIELDS
+
+# Nutrient of each entry of a legacy coefficient list, which is the order DEFAULT_COEFFICIENTS used to be written in.
+# Note that it is not NUTRITION_FIELDS order: the vitamins come as C, D, A.  See from_legacy_list
+POSITIONAL_COEFFICIENT_ORDER = (
+    'calories', 'carbohydrate', 'protein', 'total_fat', 'saturated_fat', 'trans_fat',
+    'sugar', 'cholesterol', 'fiber', 'sodium', 'potassium', 'calcium', 'iron',
+    'vitamin_c', 'vitamin_d', 'vitamin_a',
+)
+
+Coefficients = Union[Nutrition, dict]
+
+
+def nutrition_vector(nutrition: Nutrition) -> np.ndarray:
+    """
+    @return: The nutrition facts as a (16,) array, in NUTRITION_FIELDS order
+    """
+    return np.array([getattr(nutrition, name) for name in NUTRITION_FIELDS], dtype=np.float64)
+
+
+def from_legacy_list(values: Sequence[float]) -> dict:
+    """
+    @param values: Coefficients in POSITIONAL_COEFFICIENT_ORDER, as they used to be written
+    @return: dict of nutrient name -> weight, usable as Coefficients
+    """
+    if len(values) != len(POSITIONAL_COEFFICIENT_ORDER):
+        raise ValueError(f'Expected {len(POSITIONAL_COEFFICIENT_ORDER)} coefficients, got {len(values)}')
+    return dict(zip(POSITIONAL_COEFFICIENT_ORDER, values))
+
+
+def coefficient_vector(coefficients: Coefficients) -> np.ndarray:
+    """
+    Converts nutrient weights to a (16,) array in NUTRITION_FIELDS order
+    @param coefficients: Either a Nutrition object holding the weights, or a dict of nutrient name -> weight (missing
+    nutrients get 0).  Positional weights are not accepted, see from_legacy_list
+    @return: The weights as an array
+    """
+    if isinstance(coefficients, Nutrition):
+        return nutrition_vector(coefficients)
+    if isinstance(coefficients, dict):
+        for name in coefficients:
+            if name not in NUTRITION_FIELDS:
+                raise ValueError(f'Unknown nutrient {name}')
+        return np.array([coefficients.get(name, 0.) for name in NUTRITION_FIELDS], dtype=np.float64)
+    raise TypeError(f'Expected Nutrition or dict coefficients, got {type(coefficients).__name__}')
+
+
+def nutrition_cost(totals: np.ndarray, lo: np.ndarray, hi: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    The cost of nutrition totals: for every nutrient, the squared distance of the total to the allowed [lo, hi] range,
+    weighted by the nutrient's coefficient and summed.  This is the cost SimulatedAnnealing minimizes.
+    @param totals: (..., 16) nutrition totals, in NUTRITION_FIELDS order
+    @param lo: Lower bounds, broadcastable to totals (e.g. (16,) or one row per requirement set)
+    @param hi: Upper bounds, same shape as lo
+    @param weights: (16,) nutrient weights, see coefficient_vector
+    @return: (...) costs
+    """
+    dist = np.maximum(lo - totals, 0) + np.maximum(totals - hi, 0)
+    return (dist ** 2) @ weights
+
+
+def in_range(totals: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    @param totals: (..., 16) nutrition totals
+    @param lo: Lower bounds, broadcastable to totals
+    @param hi: Upper bounds, same shape as lo
+    @return: (..., 16) bool array, whether each nutrient is within its allowed range
+    """
+    return (lo <= totals) & (totals <= hi)
@@ -0,0 +1,216 @@
+import itertools
+import math
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+
+from common import NUTRITION_FIELDS
+from cost import Coefficients, coefficient_vector, nutrition_cost, nutrition_vector
+from portion import INITIAL_TEMP, SimulatedAnnealing, PlateSectionState, MealItemSpec
+from requirements import nutritional_info_for, StudentProfileSpec
+
+SECTION_NAMES = ('large', 'small1', 'small2')
+# Initial annealing temperature of triples warm-started from a neighbour's solution (cold runs start at INITIAL_TEMP)
+WARM_START_TEMP = 0.1
+
+
+class TripleCostOracle:
+    def __init__(self, profile: StudentProfileSpec, container_volumes: tuple[float, float, float],
+                 coefficients: Coefficients, sa_alpha: float, sa_lo: float, seed: int, cache: Optional[dict] = None,
+                 solutions: Optional[dict] = None, warm_start: bool = True):
+        """
+        Lazily computes the annealed cost of (large, small1, small2) triples.  A triple is only annealed the first time
+        its cost is asked for, and is memoized after that.  Two closed-form surrogates of every triple's cost are
+        available for free to order and prune requests (see surrogates).
+        @param profile: The student
+        @param container_volumes: Size of the large, small1 and small2 plate sections
+        @param coefficients: Nutrient weights, see cost.coefficient_vector
+        @param sa_alpha: Alpha for simulated annealing runs
+        @param sa_lo: Minimum temperature for simulated annealing runs
+        @param seed: RNG seed for simulated annealing runs
+        @param cache: Optional dict of (large id, small1 id, small2 id) -> annealed cost to share between oracles with
+        the same profile requirements and parameters
+        @param solutions: Optional dict of (large id, small1 id, small2 id) -> fill ratio (volume / max volume) of each
+        section in the annealed solution, shared the same way as cache
+        @param warm_start: Whether to start annealing a triple from the solution of the most similar solved triple
+        sharing two of its items (with a shorter cooling schedule, see WARM_START_TEMP), instead of from mid volumes
+        """
+        self.profile = profile
+        self.container_volumes = container_volumes
+        self.coefficients = coefficients
+        self.sa_alpha = sa_alpha
+        self.sa_lo = sa_lo
+        self.seed = seed
+        self.cache = cache if cache is not None else {}
+        self.solutions = solutions if solutions is not None else {}
+        self.warm_start = warm_start
+
+        self.lo, self.hi = (nutrition_vector(req) for req in nutritional_info_for(profile))
+        self.weights = coefficient_vector(coefficients)
+        self._section_arrays = {}
+        # (section left out, the other two ids) -> solved triples sharing those two items
+        self._solved_by_pair = defaultdict(list)
+        for key in self.solutions:
+            self._index_solution(key)
+        self.num_annealed = 0
+        self.num_warm_started = 0
+
+    def known(self, item_l: MealItemSpec, item_s1: MealItemSpec, item_s2: MealItemSpec) -> Optional[float]:
+        """
+        @return: The cost of the triple if it was already computed, None otherwise
+        """
+        return self.cache.get((item_l.id, item_s1.id, item_s2.id))
+
+    def _index_solution(self, key: tuple):
+        for section in range(len(key)):
+            self._solved_by_pair[section, key[:section] + key[section + 1:]].append(key)
+
+    def _state(self, items: tuple) -> list[PlateSectionState]:
+        return [PlateSectionState.from_item_spec(item, volume, 1, name)
+                for item, volume, name in zip(items, self.container_volumes, SECTION_NAMES)]
+
+    def _warm_start_volumes(self, state: list[PlateSectionState]) -> Optional[list]:
+        """
+        @return: The section volumes of the solved triple sharing two items with the state that fit the state best
+        (i.e. with the lowest cost at those fill ratios), or None if there is no such triple or none of them fits
+        better than the mid volumes where cold runs start
+        """
+        key = tuple(s.id for s in state)
+        candidates = [neighbour for section in range(len(key))
+                      for neighbour in self._solved_by_pair.get((section, key[:section] + key[section + 1:]), [])]
+        if not candidates:
+            return None
+        max_volumes = np.array([s.max_volume for s in state], dtype=np.float64)
+        starts = np.array([self.solutions[neighbour] for neighbour in candidates]) * max_volumes
+        unit_nutrition = np.array([nutrition_vector(s.nutrition) / s.portion_volume for s in state])
+        costs = nutrition_cost(starts @ unit_nutrition, self.lo, self.hi, self.weights)
+        mid_cost = nutrition_cost(np.array([s.volume for s in (x.with_mid_volume() for x in state)]) @ unit_nutrition,
+                                  self.lo, self.hi, self.weights)
+        best = int(costs.argmin())
+        return list(starts[best]) if costs[best] < mid_cost else None
+
+    def _solve(self, items: tuple):
+        key = tuple(item.id for item in items)
+        if key in self.cache and key in self.solutions:
+            return
+        state = self._state(items)
+        initial_volumes = self._warm_start_volumes(state) if self.warm_start else None
+        warm = initial_volumes is not None
+        sa = SimulatedAnnealing(profile=self.profile,
+                                state=state,
+                                coefficients=self.coefficients,
+                                alpha=self.sa_alpha,
+                                smallest_temp=self.sa_lo,
+                                seed=self.seed,
+                                initial_volumes=initial_volumes,
+                                initial_temp=WARM_START_TEMP if warm else INITIAL_TEMP,
+                                keep_best=warm)
+        sa.run_algorithm()
+        self.cache.setdefault(key, sa.final_cost)
+        if key not in self.solutions:
+            self.solutions[key] = tuple(s.volume / s.max_volume if s.max_volume else 0. for s in sa.state)
+            self._index_solution(key)
+        self.num_annealed += 1
+        self.num_warm_started += warm
+
+    def cost(self, item_l: MealItemSpec, item_s1: MealItemSpec, item_s2: MealItemSpec) -> float:
+        """
+        @return: The annealed cost of the triple (annealing it if needed)
+        """
+        key = item_l.id, item_s1.id, item_s2.id
+        if key not in self.cache:
+            self._solve((item_l, item_s1, item_s2))
+        return self.cache[key]
+
+    def portions(self, item_l: MealItemSpec, item_s1: MealItemSpec, item_s2: MealItemSpec) -> list[PlateSectionState]:
+        """
+        @return: The plate sections of the triple at their annealed volumes (annealing it if needed)
+        """
+        items = item_l, item_s1, item_s2
+        key = tuple(item.id for item in items)
+        if key not in self.solutions:
+            self._solve(items)
+        state = self._state(items)
+        for s, ratio in zip(state, self.solutions[key]):
+            s.volume = int(round(ratio * s.max_volume)) if s.discrete else ratio * s.max_volume
+        return state
+
+    def _arrays(self, items: list[MealItemSpec], section: int):
+        """
+        @return: (mid, min, max) arrays of shape (len(items), 16): nutrition of each item in the section at its mid
+        volume, and the elementwise min/max nutrition over its volume range
+        """
+        missing = [item for item in items if (item.id, section) not in self._section_arrays]
+        for item in missing:
+            state = PlateSectionState.from_item_spec(item, self.container_volumes[section], 1, SECTION_NAMES[section])
+            mid, at_min, at_max = (nutrition_vector(s.scaled_nutrition()) for s in (
+                state.with_mid_volume(), state.with_min_volume(), state.with_max_volume()))
+            self._section_arrays[item.id, section] = mid, np.minimum(at_min, at_max), np.maximum(at_min, at_max)
+
+        arrays = [self._section_arrays[item.id, section] for item in items]
+        return tuple(np.array([a[i] for a in arrays]).reshape(len(items), len(NUTRITION_FIELDS)) for i in range(3))
+
+    def surrogates(self, large_items: list[MealItemSpec], small1_items: list[MealItemSpec],
+                   small2_items: list[MealItemSpec]):
+        """
+        Closed-form estimates of the annealed cost of every triple
+        @return: (mid, lower) arrays of shape (L, S1, S2).  mid is the cost with every section at its mid volume,
+        which is where annealing starts.  lower is a lower bound of the cost at any volumes, obtained by bounding each
+        nutrient total by its own min/max (ignoring that all nutrients move together with the volumes).  Already
+        computed triples are not substituted.
+        """
+        (mid_l, min_l, max_l), (mid_s1, min_s1, max_s1), (mid_s2, min_s2, max_s2) = (
+            self._arrays(items, section) for section, items in enumerate((large_items, small1_items, small2_items)))
+        shape = len(large_items), len(small1_items), len(small2_items)
+        mid, lower = np.empty(shape), np.empty(shape)
+        for i in range(shape[0]):  # One large item at a time, so memory stays at S1 x S2 x 16
+            mid[i] = nutrition_cost(mid_l[i] + mid_s1[:, None] + mid_s2[None], self.lo, self.hi, self.weights)
+            dist = np.maximum(self.lo - (max_l[i] + max_s1[:, None] + max_s2[None]), 0) + \
+                np.maximum((min_l[i] + min_s1[:, None] + min_s2[None]) - self.hi, 0)
+            lower[i] = (dist ** 2) @ self.weights
+        return mid, lower
+
+    def item_bounds(self, large_items: list[MealItemSpec], small1_items: list[MealItemSpec],
+                    small2_items: list[MealItemSpec]) -> list[np.ndarray]:
+        """
+        Lower bound of the cost of any triple containing each item, like the lower surrogate but with the other two
+        sections' nutrition bounded by their min/max over all of their items.  Linear in the number of items
+        @return: One array of bounds per section, of shape (number of items,).  All zeros if a section is empty
+        """
+        sets = large_items, small1_items, small2_items
+        if not all(sets):
+            return [np.zeros(len(items)) for items in sets]
+        arrays = [self._arrays(items, section) for section, items in enumerate(sets)]
+        bounds = []
+        for section in range(3):
+            others = [arrays[other] for other in range(3) if other != section]
+            dist = np.maximum(self.lo - (arrays[section][2] + sum(a[2].max(axis=0) for a in others)), 0) + \
+                np.maximum((arrays[section][1] + sum(a[1].min(axis=0) for a in others)) - self.hi, 0)
+            bounds.append((dist ** 2) @ self.weights)
+        return bounds
+
+    def set_cost(self, large_items: list[MealItemSpec], small1_items: list[MealItemSpec],
+                 small2_items: list[MealItemSpec], bound: float = math.inf) -> float:
+        """
+        Summed cost of every triple between the three sets, annealing as few triples as possible.  Triples are
+        annealed in decreasing order of mid-volume cost, and the computation stops as soon as the exact costs so far
+        plus the lower bounds of the remaining triples reach bound.
+        @param bound: Only costs below this value are of interest
+        @return: The summed cost, or math.inf if it is proven to be >= bound
+        """
+        mid, lower = self.surrogates(large_items, small1_items, small2_items)
+        triples = list(itertools.product(*(range(n) for n in mid.shape)))
+        sets = large_items, small1_items, small2_items
+        exact = [self.known(*(items[i] for items, i in zip(sets, idx))) for idx in triples]
+
+        total = sum(cost for cost in exact if cost is not None)
+        remaining = sum(lower[idx] for idx, cost in zip(triples, exact) if cost is None)
+        if total + remaining >= bound:
+            return math.inf
+        for idx in sorted((idx for idx, cost in zip(triples, exact) if cost is None), key=lambda idx: -mid[idx]):
+            total += self.cost(*(items[i] for items, i in zip(sets, idx)))
+            remaining -= lower[idx]
+            if total + remaining >= bound:
+                return math.inf
+        return total
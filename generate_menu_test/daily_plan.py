@@ -0,0 +1,125 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+from common import MEALS, NUTRITION_FIELDS
+from cost import coefficient_vector, nutrition_cost, nutrition_vector
+from item_choice import DEFAULT_PARAMS, MealItemSelector, PlateSection, section_categories
+from portion import MealItemSpec, nutrition_of
+from requirements import daily_nutritional_info_for, StudentProfileSpec
+
+# Number of candidate plates kept per meal
+DEFAULT_TOP_K = 20
+# Number of partial plans kept after each meal
+DEFAULT_BEAM_WIDTH = 4096
+
+
+class DailyPlanner:
+    def __init__(self, profile: StudentProfileSpec, menus: dict, params: Optional[dict] = None,
+                 meal_params: Optional[dict] = None, top_k: int = DEFAULT_TOP_K, beam_width: int = DEFAULT_BEAM_WIDTH,
+                 cost_caches: Optional[dict] = None):
+        """
+        Plans a student's plates for a whole day.  The top_k cheapest plates of each meal's menu (one item per section,
+        at their annealed volumes, costed against a third of the daily requirements as usual) become the meal's
+        candidates; they are found without annealing every triple, see MealItemSelector.cheapest_triples.  One candidate per meal is then chosen jointly against the daily
+        requirements, so that one meal's surplus can make up for another's shortfall.
+
+        The joint choice is a dynamic program over the meals: after each meal, the partial plans are extended with every
+        candidate of the meal, and the beam_width partial plans whose totals are closest to the matching share of the
+        daily requirements are kept.  This is exact whenever beam_width >= top_k ** (number of meals - 1).
+        @param profile: The student.  If profile.meals is not empty, only those meals are planned
+        @param menus: dict of meal (see common.MEALS) -> list of MealItemSpec available at the meal
+        @param params: MealItemSelector parameters, defaults to item_choice.DEFAULT_PARAMS
+        @param meal_params: Optional dict of meal -> parameters overriding params for that meal.  The daily plan is scored
+        with a single set of coefficients, so they cannot be overridden per meal
+        @param top_k: Number of candidate plates per meal
+        @param beam_width: Number of partial plans kept after each meal
+        @param cost_caches: Optional dict of meal -> (cost cache, solutions) shared with earlier runs for the same
+        requirements, see MealItemSelector
+        """
+        self.profile = profile
+        self.menus = menus
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.meal_params = meal_params or {}
+        for meal, overrides in self.meal_params.items():
+            if 'coefficients' in overrides and not np.array_equal(coefficient_vector(overrides['coefficients']),
+                                                                   coefficient_vector(self.params['coefficients'])):
+                raise ValueError(f'Coefficients cannot be overridden per meal ({meal})')
+        self.top_k = top_k
+        self.beam_width = beam_width
+        self.cost_caches = cost_caches if cost_caches is not None else {}
+
+        self.meals = [meal for meal in MEALS if meal in menus and (not profile.meals or meal in profile.meals)]
+        self.lo, self.hi = (nutrition_vector(req) for req in daily_nutritional_info_for(profile))
+        self._result_obj = {}
+        self.result_cost = -1
+        self.independent_cost = -1
+        self.runtime = -1
+        self.done = False
+
+    def candidates(self, meal: str):
+        """
+        Finds the top_k cheapest plates of one meal (see MealItemSelector.cheapest_triples).  Raises ValueError if the
+        menu has no item for one of the plate sections
+        @return: (plates, totals): the meal's candidate plates (lists of PlateSectionState at their annealed volumes),
+        cheapest first, and their nutrition totals as a (len(plates), 16) array
+        """
+        params = dict(self.params, **self.meal_params.get(meal, {}))
+        items: list[MealItemSpec] = self.menus[meal]
+        cost_cache, solutions = self.cost_caches.setdefault(meal, ({}, {}))
+        selector = MealItemSelector(profile=self.profile, items=items, cost_cache=cost_cache, solutions=solutions,
+                                    **params)
+        keys = [ids for ids, _ in selector.cheapest_triples(self.top_k)]
+        if not keys:
+            categories = section_categories(self.profile.health_goal, params['large_portion_max'])
+            raise ValueError(f'No plate can be made from the {meal} menu (sections: {", ".join(categories)})')
+        plates = [selector.portions(key) for key in keys]
+        totals = np.array([nutrition_vector(nutrition_of(plate)) for plate in plates]).reshape(
+            len(plates), len(NUTRITION_FIELDS))
+        return plates, totals
+
+    def run_algorithm(self):
+        """
+        Runs the algorithm
+        @return: None, the result is available through result_obj() and result_cost.  independent_cost is the daily
+        cost of taking each meal's cheapest plate on its own, for comparison
+        """
+        start_time = time.perf_counter()
+        weights = coefficient_vector(self.params['coefficients'])
+        candidates = {meal: self.candidates(meal) for meal in self.meals}
+
+        # Partial plans: (B, meals so far) candidate positions and (B, 16) nutrition totals
+        plans = np.zeros((1, 0), dtype=np.intp)
+        totals = np.zeros((1, len(NUTRITION_FIELDS)))
+        for step, meal in enumerate(self.meals):
+            meal_totals = candidates[meal][1]
+            totals = (totals[:, None] + meal_totals[None]).reshape(-1, len(NUTRITION_FIELDS))
+            plans = np.concatenate((np.repeat(plans, len(meal_totals), axis=0),
+                                    np.tile(np.arange(len(meal_totals)), len(plans))[:, None]), axis=1)
+            share = (step + 1) / len(self.meals)
+            keep = np.argsort(nutrition_cost(totals, share * self.lo, share * self.hi, weights),
+                              kind='stable')[:self.beam_width]
+            plans, totals = plans[keep], totals[keep]
+
+        if len(plans):
+            best = plans[0]
+            self.result_cost = float(nutrition_cost(totals[0], self.lo, self.hi, weights))
+            self.independent_cost = float(nutrition_cost(sum(candidates[meal][1][0] for meal in self.meals),
+                                                         self.lo, self.hi, weights)) if self.meals else 0.
+            self._result_obj = {
+                meal: {
+                    section: {
+                        'item': s.id,
+                        'volume': s.format_volume(),
+                    }
+                    for section, s in zip(PlateSection.all(), candidates[meal][0][position])
+                }
+                for meal, position in zip(self.meals, best)
+            }
+
+        self.runtime = time.perf_counter() - start_time
+        self.done = True
+
+    def result_obj(self):
+        return self._result_obj
@@ -1,43 +1,24 @@
-from portion import MealItemSpec, PlateSectionState, DEFAULT_COEFFICIENTS, SimulatedAnnealing
-from requirements import StudentProfileSpec
-from dataclasses import fields
+from portion import DEFAULT_COEFFICIENTS
+from cost_oracle import TripleCostOracle
+from requirements import profile_from_dict
+from catalog import load_items
 from item_choice import LARGE_PORTION
 from random import *
 from alive_progress import alive_bar
-import datetime
-import csv
+import math
 import os
 import json
 
 NUM_TRIALS = 10000
 
 # load items
-def mealitemspec_from_dict(d):
-    dd = {'id': d['pk']}
-    for field in fields(MealItemSpec):
-        if field.name in d:
-            dd[field.name] = d[field.name]
-    return MealItemSpec(**dd)
-
-with open('../nutrition_table.csv') as f:
-    items_dict = csv.DictReader(f)
-    items = list(map(mealitemspec_from_dict, items_dict))
+items = load_items()
 
 print(f'got {len(items)} items')
 
 # load person
 with open('fake_person.json') as f:
-    obj = json.load(f)
-    profile = StudentProfileSpec(
-            height=obj['Height'],
-            weight=obj['Weight'],
-            birthdate=datetime.date.fromisoformat(obj['Birthdate']),
-            meals=[],
-            meal_length=0,
-            sex=obj['Sex'],
-            health_goal=obj['Health_Goal'],
-            activity_level=obj['Activity_Level']
-    )
+    profile = profile_from_dict(json.load(f))
 
 def filter_category(category):
     return lambda x: x.category == category
@@ -52,35 +33,13 @@ if large_cat == 'vegetable':
 elif large_cat == 'grain':
     small1, large = large, small1
 
-cache = {}
-def get_cost(item1, item2, item3):
-    key = f'{item1.id}_{item2.id}_{item3.id}'
-
-    if key in cache:
-        return cache[key]
-
-    sim = SimulatedAnnealing(profile, \
-            [PlateSectionState.from_item_spec(item, volume, 1, name) for \
-            item, volume, name in zip((item1, item2, item3), (610, 270, 270), ('large', 'small1', 'small2'))], \
-            DEFAULT_COEFFICIENTS, \
-            0.99, \
-            0.01, \
-            20210226)
-
-    sim.run_algorithm()
-
-    cache[key] = sim.final_cost
-    return sim.final_cost
+oracle = TripleCostOracle(profile, (610, 270, 270), DEFAULT_COEFFICIENTS, 0.99, 0.01, 20210226)
 
 print(f'Large count: {len(large)}, small1 count: {len(small1)}, small2 count: {len(small2)}')
 
-def all_cost(a, b, c):
-    tot = 0
-    for x in a:
-        for y in b:
-            for z in c:
-                tot += get_cost(x, y, z)
-    return tot
+def all_cost(a, b, c, bound=math.inf):
+    # Only anneals the triples needed to tell whether the cost is below bound (inf if it isn't)
+    return oracle.set_cost(a, b, c, bound)
 
 def map_names(items):
     return list(map(lambda x: x.name, items))
@@ -112,7 +71,7 @@ try:
                 old_item = l_item[item_num]
 
                 l_item[item_num] = new_item
-                new_cost = all_cost(large_ans, small1_ans, small2_ans)
+                new_cost = all_cost(large_ans, small1_ans, small2_ans, best_cost)
 
                 if best_cost == -1 or new_cost < best_cost:
                     num_best += 1
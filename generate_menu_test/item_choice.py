@@ -1,9 +1,18 @@
+import heapq
 import itertools
+import math
 import time
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
 
 from common import BUILD_MUSCLE, LOSE_WEIGHT, ATHLETIC_PERFORMANCE, IMPROVE_TONE, IMPROVE_HEALTH, PROTEIN, GRAINS, \
     VEGETABLE
-from portion import SimulatedAnnealing, PlateSectionState, MealItemSpec
+from catalog import identical_groups
+from cost import Coefficients
+from cost_oracle import TripleCostOracle
+from portion import DEFAULT_COEFFICIENTS, MealItemSpec, PlateSectionState
 from requirements import nutritional_info_for, StudentProfileSpec
 
 
@@ -31,10 +40,171 @@ LARGE_PORTION = {
 CHOOSE_COUNT = 3
 
 
+def section_categories(health_goal: str, large_portion_max: float) -> tuple[str, str, str]:
+    """
+    @param health_goal: Health goal of the student
+    @param large_portion_max: Size of the large plate section
+    @return: The item category of the large, small1 and small2 sections
+    """
+    large_category, small1_category, small2_category = PROTEIN, VEGETABLE, GRAINS
+    large_portion = LARGE_PORTION[health_goal]
+    # TODO: remove later, temporary workaround to allow for 2 sections for testing breakfast
+    if large_portion_max == 0:
+        large_portion = PROTEIN
+
+    if large_portion == VEGETABLE:
+        large_category, small1_category = small1_category, large_category
+    elif large_portion == GRAINS:
+        large_category, small2_category = small2_category, large_category
+    return large_category, small1_category, small2_category
+
+
+# Max number of floats held in memory at once by the combination search
+SEARCH_BLOCK_ELEMENTS = 2 ** 22
+
+
+def _combination_array(n: int, k: int) -> np.ndarray:
+    """
+    @return: (C(n, k), k) array of all k-combinations of range(n), in lexicographic order
+    """
+    combs = list(itertools.combinations(range(n), k))
+    return np.array(combs, dtype=np.intp).reshape(len(combs), k)
+
+
+def best_combination(costs: np.ndarray, choose_count: int = CHOOSE_COUNT):
+    """
+    Finds the sets of items (choose_count per section) minimizing the summed cost of every triple between them.  The
+    summed cost is additive over the small2 items, so for fixed large and small1 sets the best small2 set is just its
+    choose_count cheapest items; only the large x small1 combinations are enumerated (in vectorized blocks).
+    @param costs: (L, S1, S2) array, costs[i, j, k] is the cost of the triple (i-th large, j-th small1, k-th small2)
+    @param choose_count: How many items to pick per section (fewer if a section does not have enough items)
+    @return: (large positions, small1 positions, small2 positions, summed cost), positions are sorted tuples
+    """
+    n_l, n_s1, n_s2 = costs.shape
+    k_l, k_s1, k_s2 = (min(choose_count, n) for n in costs.shape)
+    combs_l = _combination_array(n_l, k_l)
+    combs_s1 = _combination_array(n_s1, k_s1)
+
+    best, best_cost = None, float('inf')
+    step = max(1, SEARCH_BLOCK_ELEMENTS // max(1, (len(combs_s1) * k_s1 + n_s1) * n_s2))
+    for start in range(0, len(combs_l), step):
+        # (block, S1, S2): summed over the chosen large items, then (block, C(S1), S2): summed over small1 items
+        by_l = costs[combs_l[start:start + step]].sum(axis=1)
+        by_ls1 = by_l[:, combs_s1].sum(axis=2)
+        if k_s2 == 0:
+            totals = np.zeros(by_ls1.shape[:2])
+        else:
+            totals = np.partition(by_ls1, k_s2 - 1, axis=2)[:, :, :k_s2].sum(axis=2)
+
+        a, b = np.unravel_index(np.argmin(totals), totals.shape)
+        if totals[a, b] < best_cost:
+            best_cost = float(totals[a, b])
+            best = start + a, b, by_ls1[a, b]
+
+    a, b, by_s2 = best
+    s2 = tuple(sorted(int(z) for z in np.argsort(by_s2, kind='stable')[:k_s2]))
+    return tuple(map(int, combs_l[a])), tuple(map(int, combs_s1[b])), s2, best_cost
+
+
+def improve_combination(costs: np.ndarray, start=None, deadline: Optional[float] = None,
+                        choose_count: int = CHOOSE_COUNT):
+    """
+    Local search version of best_combination.  With two of the sets fixed, the best set of the remaining section is just
+    its choose_count items with the smallest summed cost against the fixed sets, so sections are re-optimized one at a
+    time until none of them improves (or the deadline passes).
+    @param costs: (L, S1, S2) array of triple costs, see best_combination
+    @param start: Initial (large, small1, small2) positions, defaults to the items with the smallest total cost
+    @param deadline: time.perf_counter() value after which to stop improving
+    @param choose_count: How many items to pick per section
+    @return: (large positions, small1 positions, small2 positions, summed cost), positions are sorted tuples
+    """
+    ks = [min(choose_count, n) for n in costs.shape]
+    if start is None:
+        start = [np.argsort(costs.sum(axis=tuple(a for a in range(3) if a != axis)), kind='stable')[:k]
+                 for axis, k in enumerate(ks)]
+    sets = [np.sort(np.asarray(positions, dtype=np.intp)) for positions in start]
+
+    changed = True
+    while changed and (deadline is None or time.perf_counter() < deadline):
+        changed = False
+        for axis in range(3):
+            sub = costs[np.ix_(*(np.arange(n) if a == axis else sets[a] for a, n in enumerate(costs.shape)))]
+            marginal = sub.sum(axis=tuple(a for a in range(3) if a != axis))
+            best = np.sort(np.argsort(marginal, kind='stable')[:ks[axis]])
+            if marginal[best].sum() < marginal[sets[axis]].sum():
+                sets[axis] = best
+                changed = True
+
+    l1, l2, l3 = (tuple(int(x) for x in positions) for positions in sets)
+    return l1, l2, l3, float(costs[np.ix_(*sets)].sum())
+
+
+def repair_combination(costs: np.ndarray, kept, choose_count: int = CHOOSE_COUNT):
+    """
+    Completes a partial selection, e.g. a previous selection some of whose items were removed from the menu.  Missing
+    items are added one section at a time, picking the items with the smallest summed cost against the other sections'
+    (completed or kept) items.
+    @param costs: (L, S1, S2) array of triple costs, see best_combination
+    @param kept: (large, small1, small2) positions still selected, possibly fewer than choose_count per section
+    @param choose_count: How many items to pick per section
+    @return: (large, small1, small2) sorted position arrays with choose_count items each (fewer if a section does not
+    have enough items), usable as improve_combination's start
+    """
+    sets = [np.unique(np.asarray(positions, dtype=np.intp)) for positions in kept]
+    for axis, n in enumerate(costs.shape):
+        k = min(choose_count, n)
+        if len(sets[axis]) >= k:
+            continue
+        others = [sets[a] if len(sets[a]) else np.arange(costs.shape[a]) for a in range(3)]
+        sub = costs[np.ix_(*(np.arange(n) if a == axis else others[a] for a in range(3)))]
+        marginal = sub.sum(axis=tuple(a for a in range(3) if a != axis))
+        marginal[sets[axis]] = np.inf
+        extra = np.argsort(marginal, kind='stable')[:k - len(sets[axis])]
+        sets[axis] = np.sort(np.concatenate((sets[axis], extra)))
+    return sets
+
+
+# Above this many (large set, small1 set) pairs, the search is too slow to repeat after every few annealing runs, so
+# anytime mode uses improve_combination instead of best_combination.  Without a time budget, the exact search is
+# repeated up to UNTIMED_EXACT_SEARCH_PAIRS, which still anneals far fewer triples than the whole menu
+EXACT_SEARCH_PAIRS = 10 ** 5
+UNTIMED_EXACT_SEARCH_PAIRS = 10 ** 7
+
+
+def _exact_search_feasible(shape: tuple, max_pairs: int = EXACT_SEARCH_PAIRS) -> bool:
+    """
+    @param shape: Number of large, small1 and small2 items
+    @param max_pairs: Max number of (large set, small1 set) pairs
+    @return: Whether best_combination is cheap enough to run repeatedly
+    """
+    return math.comb(shape[0], min(CHOOSE_COUNT, shape[0])) * \
+        math.comb(shape[1], min(CHOOSE_COUNT, shape[1])) <= max_pairs
+
+
+# Number of extra triples annealed at a time by anytime mode once its current selection is fully annealed
+REFINE_BATCH = 32
+# Share of anytime mode's time budget the surrogate costs may take.  Larger menus are cut down to their most promising
+# items (see TripleCostOracle.item_bounds) until their surrogates fit in it
+SURROGATE_SHARE = 0.5
+
+
+# Same parameters as generate_menu.py
+DEFAULT_PARAMS = dict(
+    large_portion_max=610,
+    small_portion_max=270,
+    coefficients=DEFAULT_COEFFICIENTS,
+    sa_alpha=0.99,
+    sa_lo=0.01,
+    seed=20210226,
+)
+
+
 class MealItemSelector:
     def __init__(self, profile: StudentProfileSpec, items: list[MealItemSpec],
                  large_portion_max: float, small_portion_max: float,
-                 coefficients: tuple[float], sa_alpha: float, sa_lo: float, seed: int):
+                 coefficients: Coefficients, sa_alpha: float, sa_lo: float, seed: int,
+                 cost_cache: Optional[dict] = None, solutions: Optional[dict] = None, warm_start: bool = True,
+                 dedupe: bool = True):
         """
         Creates a MealItemSelector object, which runs the algorithm that selects the best item choices given a list of
         meal items.
@@ -42,13 +212,19 @@ class MealItemSelector:
         @param items: A list of MealItemSpec, which represent the list of meal items available at the meal
         @param large_portion_max: Size of the large plate section (mL)
         @param small_portion_max: Size of the small plate sections (mL)
-        @param coefficients: List of weights denoting how much each nutrient is weighted.  The cost of a state is
-        determined by the distance of its nutrition facts to the 'allowed' range.  Euclidian distance**2 is the metric
-        used to measure how far each nutrient is from its goal.  These are then scaled by the individual coefficients.
-        See SimulatedAnnealing.cost_of for more details on which coefficient affects what.
+        @param coefficients: Weights denoting how much each nutrient is weighted, keyed by nutrient (see
+        cost.coefficient_vector).  The cost of a state is determined by the distance of its nutrition facts to the
+        'allowed' range.  Euclidian distance**2 is the metric used to measure how far each nutrient is from its goal.
+        These are then scaled by the individual coefficients.  See cost.nutrition_cost.
         @param sa_alpha: Alpha for simulated annealing runs
         @param sa_lo: Minimum temperature for simulated annealing runs
         @param seed: RNG seed for simulated annealing runs
+        @param cost_cache: Optional dict of (large id, small1 id, small2 id) -> annealed cost, shared between runs with
+        the same profile requirements and parameters.  Cached triples are not annealed again, and new ones are added.
+        @param solutions: Optional dict of triple -> annealed fill ratios, shared like cost_cache (see TripleCostOracle)
+        @param warm_start: Whether to warm-start annealing runs from solved neighbouring triples
+        @param dedupe: Whether to evaluate nutritionally identical items once (see _sections).  The result still lists
+        the original ids
         """
         self.profile = profile
         self.items = items
@@ -59,6 +235,11 @@ class MealItemSelector:
         self.seed = seed
         self.large_portion_max = large_portion_max
         self.small_portion_max = small_portion_max
+        self.dedupe = dedupe
+        self.oracle = TripleCostOracle(profile, (large_portion_max, small_portion_max, small_portion_max),
+                                       coefficients, sa_alpha, sa_lo, seed, cost_cache, solutions, warm_start)
+        self.cost_cache = self.oracle.cache
+        self.solutions = self.oracle.solutions
 
         self.requirements = nutritional_info_for(profile)
         self._result_obj = {}
@@ -66,84 +247,287 @@ class MealItemSelector:
         self.runtime = -1
         self.done = False
 
-    def run_algorithm(self):
-        large_category = PROTEIN
-        small1_category = VEGETABLE
-        small2_category = GRAINS
+    def _sections(self):
+        """
+        @return: (categories, items, representatives) of the large, small1 and small2 sections.  With dedupe, items
+        that are nutritionally identical (see catalog.identical_groups) are evaluated through the first item of their
+        group, so representatives[section][i] is the item whose triples stand for items[section][i].  Groups are cut
+        down to CHOOSE_COUNT items, since no selection can hold more copies of the same dish.
+        """
+        categories = section_categories(self.profile.health_goal, self.large_portion_max)
+        sections = [[item for item in self.items if item.category == category] for category in categories]
+        if not self.dedupe:
+            return categories, sections, sections
+        groups = [identical_groups(items) for items in sections]
+        return (categories, [[item for group in section_groups for item in group[:CHOOSE_COUNT]]
+                             for section_groups in groups],
+                [[group[0] for group in section_groups for _ in group[:CHOOSE_COUNT]] for section_groups in groups])
+
+    def _prune_sections(self, sections, deadline: float):
+        """
+        Cuts the sections down so that their surrogate costs can be computed in SURROGATE_SHARE of the time left.  The
+        time per triple is measured on the first few large items, and every section keeps the same share of its items,
+        those with the smallest item_bounds
+        @return: (positions of the kept items per section, sorted, lower bound of the cost of any selection with a
+        dropped item (math.inf if nothing was dropped))
+        """
+        keep = [np.arange(len(items)) for items in sections]
+        size = int(np.prod([len(items) for items in sections]))
+        if not size:
+            return keep, math.inf
+        bounds = self.oracle.item_bounds(*sections)
+        order = [np.argsort(b, kind='stable') for b in bounds]
+        probe = [sections[0][i] for i in order[0][:CHOOSE_COUNT]]
+        probe_start = time.perf_counter()
+        self.oracle.surrogates(probe, *sections[1:])
+        per_triple = (time.perf_counter() - probe_start) / (len(probe) * len(sections[1]) * len(sections[2]))
+        budget = SURROGATE_SHARE * max(0., deadline - time.perf_counter()) / max(per_triple, 1e-12)
+        if size <= budget:
+            return keep, math.inf
+
+        share = (budget / size) ** (1 / 3)
+        dropped_bound = math.inf
+        ks = [min(CHOOSE_COUNT, len(items)) for items in sections]
+        for axis, items in enumerate(sections):
+            n = max(ks[axis], int(len(items) * share))
+            keep[axis] = np.sort(order[axis][:n])
+            if n < len(items):
+                # A selection with a dropped item has that many triples holding it
+                others = int(np.prod([k for a, k in enumerate(ks) if a != axis]))
+                dropped_bound = min(dropped_bound, others * float(bounds[axis][order[axis][n]]))
+        return keep, dropped_bound
+
+    def _run_lazy(self, sections, deadline: Optional[float], kept=None):
+        """
+        Lazy version of the algorithm, which only anneals the triples the search needs.  Every triple starts with two
+        closed-form estimates (see TripleCostOracle.surrogates): a lower bound, and its mid-volume cost.  The selection
+        is searched on the lower bounds, the triples of that selection are annealed (making their bounds exact), and the
+        search is repeated.  Once the searched selection is fully annealed and the search is exact, it is optimal.  With
+        an inexact search (see EXACT_SEARCH_PAIRS), the search stops there, or in anytime mode the remaining time goes
+        to the triples with the smallest lower bounds.
+
+        If the deadline passes first, the returned selection is searched on the annealed costs where available, and
+        elsewhere on estimates interpolated between the two surrogates according to how the annealed triples compared to
+        theirs.  Menus too large to compute every surrogate in time are first cut down, see _prune_sections.
+        @param sections: Items (representatives) of the large, small1 and small2 sections
+        @param deadline: time.perf_counter() value at which to stop annealing, None to run until done
+        @param kept: Optional partial selection (positions per section) to start the search from, see
+        repair_combination.  Only used by the inexact search
+        @return: (positions of the selected items per section, cost, quality dict)
+        """
+        full_shape = tuple(map(len, sections))
+        keep, dropped_bound = ([np.arange(n) for n in full_shape], math.inf) if deadline is None else \
+            self._prune_sections(sections, deadline)
+        sections = [[items[i] for i in positions] for items, positions in zip(sections, keep)]
+        if kept is not None:
+            new_positions = [{int(old): new for new, old in enumerate(positions)} for positions in keep]
+            kept = [[lookup[i] for i in section_kept if i in lookup] for lookup, section_kept in zip(new_positions, kept)]
+
+        surrogate_mid, surrogate_lower = self.oracle.surrogates(*sections)
+        mid, lower = surrogate_mid.copy(), surrogate_lower.copy()
+        annealed = np.zeros(mid.shape, dtype=bool)
+        index = [defaultdict(list) for _ in sections]
+        for idx, items in zip(index, sections):
+            for i, item in enumerate(items):
+                idx[item.id].append(i)
+        for key, cost in self.cost_cache.items():
+            if all(item_id in idx for item_id, idx in zip(key, index)):
+                for pos in itertools.product(*(idx[item_id] for item_id, idx in zip(key, index))):
+                    mid[pos] = lower[pos] = cost
+                    annealed[pos] = True
+
+        exact_search = _exact_search_feasible(
+            mid.shape, EXACT_SEARCH_PAIRS if deadline is not None else UNTIMED_EXACT_SEARCH_PAIRS)
 
-        large_items = [item for item in self.items if item.category == PROTEIN]
-        small1_items = [item for item in self.items if item.category == VEGETABLE]
-        small2_items = [item for item in self.items if item.category == GRAINS]
+        def search(costs, start, until=None):
+            return best_combination(costs) if exact_search else improve_combination(costs, start, until)
 
-        large_portion = LARGE_PORTION[self.profile.health_goal]
-        # TODO: remove later, temporary workaround to allow for 2 sections for testing breakfast
-        if self.large_portion_max == 0:
-            large_portion = PROTEIN
+        def time_left():
+            return deadline is None or time.perf_counter() < deadline
 
-        if large_portion == VEGETABLE:
-            large_items, small1_items = small1_items, large_items
-            large_category, small1_category = small1_category, large_category
-        elif large_portion == GRAINS:
-            large_items, small2_items = small2_items, large_items
-            large_category, small2_category = small2_category, large_category
+        by_bound = None
+        positions = None if kept is None or exact_search else repair_combination(lower, kept)
+        optimal = False
+        while time_left():
+            positions = search(lower, positions, deadline)[:3]
+            pending = [idx for idx in itertools.product(*positions) if not annealed[idx]]
+            if not pending:
+                if exact_search:
+                    optimal = True  # Annealed cost <= lower bound of any other selection
+                    break
+                if deadline is None:
+                    break  # Local optimum of the annealed costs
+                if by_bound is None:
+                    order = np.argsort(lower, axis=None, kind='stable')
+                    by_bound = (np.unravel_index(flat, mid.shape) for flat in order)
+                pending = list(itertools.islice((idx for idx in by_bound if not annealed[idx]), REFINE_BATCH))
+                if not pending:
+                    break  # Everything is annealed
 
-        cost_cache = {}
+            for idx in pending:
+                if not time_left():
+                    break
+                mid[idx] = lower[idx] = self.oracle.cost(*(items[i] for items, i in zip(sections, idx)))
+                annealed[idx] = True
+
+        num_selected = int(np.prod([min(CHOOSE_COUNT, len(items)) for items in sections]))
+        if exact_search:
+            lower_bound = search(lower, None)[3]
+        else:
+            # Any selection is made of num_selected distinct triples
+            lower_bound = float(np.partition(lower, num_selected - 1, axis=None)[:num_selected].sum()) \
+                if num_selected else 0.
+        # Unannealed triples are estimated between their lower bound and mid-volume cost, at the (median) relative
+        # position annealed triples ended up at
+        if annealed.any():
+            spread = surrogate_mid[annealed] - surrogate_lower[annealed]
+            ratios = (mid[annealed] - surrogate_lower[annealed])[spread > 0] / spread[spread > 0]
+            ratio = float(np.clip(np.median(ratios), 0, 1)) if len(ratios) else 1.
+            mid = np.where(annealed, mid, surrogate_lower + ratio * (surrogate_mid - surrogate_lower))
+        *positions, cost = search(mid, positions, deadline)
+        quality = {
+            'lower_bound': min(lower_bound, dropped_bound),
+            'exact': bool(all(annealed[idx] for idx in itertools.product(*positions))),
+            'optimal': optimal and cost <= dropped_bound,
+            'annealed_fraction': float(annealed.sum() / np.prod(full_shape)) if annealed.size else 1.,
+        }
+        positions = [tuple(int(section_keep[i]) for i in section_positions)
+                     for section_keep, section_positions in zip(keep, positions)]
+        return positions, cost, quality
+
+    def run_algorithm(self, time_budget: Optional[float] = None):
+        """
+        Runs the algorithm
+        @param time_budget: If given, runs in anytime mode (see _run_lazy) and stops annealing after this many
+        seconds.  result_obj() then also has a 'quality' entry with a lower bound on the optimal cost
+        ('lower_bound'), whether every triple of the selection was annealed ('exact'; if not, result_cost is partly
+        estimated), whether the selection is proven optimal ('optimal') and the fraction of all triples that were
+        annealed ('annealed_fraction').
+        @return: None, the result is available through result_obj() and result_cost
+        """
+        self._run(time.perf_counter(), time_budget)
+
+    def update_menu(self, added: list[MealItemSpec] = (), removed: list = (), time_budget: Optional[float] = None):
+        """
+        Re-runs the algorithm after a small menu change, reusing the previous run: annealed triple costs are kept (only
+        triples with an added item are annealed), and the search starts from the previous selection, with removed
+        items replaced by their cheapest substitutes.
+        When the menu is too large for the exact search (see EXACT_SEARCH_PAIRS and UNTIMED_EXACT_SEARCH_PAIRS), the
+        local search (improve_combination) starts from that selection, so its cost is proportional to the number of
+        changed items.  Otherwise the search is the same as a fresh run_algorithm's, but with warm starting the annealed
+        costs (and so possibly the selection and result_cost) can differ from a fresh run's, since they depend on which
+        triples were solved before.
+        @param added: New items
+        @param removed: Ids of the items that are no longer available
+        @param time_budget: See run_algorithm
+        @return: None, the result is available through result_obj() and result_cost
+        """
         start_time = time.perf_counter()
+        if not self.done:
+            raise ValueError('run_algorithm must be run before update_menu')
+        removed = set(removed)
+        for item_id in removed:
+            if item_id not in {item.id for item in self.items}:
+                raise ValueError(f'Unknown item id {item_id}')
+        for item in added:
+            if item.id in {item.id for item in self.items} - removed:
+                raise ValueError(f'Item {item.id} is already on the menu')
+
+        previous = [self._result_obj[section]['items'] for section in PlateSection.all()]
+        self.items = [item for item in self.items if item.id not in removed] + list(added)
+        self._run(start_time, time_budget, previous)
+
+    def _run(self, start_time: float, time_budget: Optional[float], previous=None):
+        """
+        @param start_time: time.perf_counter() value the run started at
+        @param time_budget: See run_algorithm
+        @param previous: Optional selected ids per section of the previous run, see update_menu
+        """
+        categories, sections, representatives = self._sections()
+        kept = None
+        if previous is not None:
+            index = [{item.id: i for i, item in enumerate(items)} for items in sections]
+            kept = [[idx[item_id] for item_id in ids if item_id in idx] for idx, ids in zip(index, previous)]
+
+        positions, best_cost, quality = self._run_lazy(
+            representatives, start_time + time_budget if time_budget is not None else None, kept)
 
-        def cache_id(item_1, item_2, item_3):
-            return f'{item_1.id}-{item_2.id}-{item_3.id}'
-
-        for item_l, item_s1, item_s2 in itertools.product(large_items, small1_items, small2_items):
-            sa = SimulatedAnnealing(profile=self.profile,
-                                    state=[PlateSectionState.from_item_spec(item, volume, 1, 'who cares')
-                                           for item, volume in zip((item_l, item_s1, item_s2), (
-                                        self.large_portion_max, self.small_portion_max, self.small_portion_max))],
-                                    coefficients=self.coefficients,
-                                    alpha=self.sa_alpha,
-                                    smallest_temp=self.sa_lo,
-                                    seed=self.seed)
-            sa.run_algorithm()
-            cost_cache[cache_id(item_l, item_s1, item_s2)] = sa.final_cost
-
-        best = [], [], []
-        best_cost = sum(cost_cache.values()) + 1
-        for comb_l, comb_s1, comb_s2 in itertools.product(
-                itertools.combinations(large_items, min(CHOOSE_COUNT, len(large_items))),
-                itertools.combinations(small1_items, min(CHOOSE_COUNT, len(small1_items))),
-                itertools.combinations(small2_items, min(CHOOSE_COUNT, len(small2_items)))
-        ):
-            l1 = list(comb_l)
-            l2 = list(comb_s1)
-            l3 = list(comb_s2)
-            cur_cost = 0
-            for x, y, z in itertools.product(l1, l2, l3):
-                cur_cost += cost_cache[cache_id(x, y, z)]
-
-            if cur_cost < best_cost:
-                best_cost = cur_cost
-                best = (l1, l2, l3)
-
-        def to_id_list(items):
-            return [item.id for item in items]
-
-        l1, l2, l3 = best
         self._result_obj = {
-            PlateSection.LARGE: {
-                'items': to_id_list(l1),
-                'category': large_category
-            },
-            PlateSection.SMALL1: {
-                'items': to_id_list(l2),
-                'category': small1_category
-            },
-            PlateSection.SMALL2: {
-                'items': to_id_list(l3),
-                'category': small2_category
-            },
+            section: {
+                'items': [items[i].id for i in section_positions],
+                'category': category
+            }
+            for section, items, section_positions, category in zip(PlateSection.all(), sections, positions, categories)
         }
+        if time_budget is not None:
+            self._result_obj['quality'] = dict(quality, cost=best_cost)
         self.result_cost = best_cost
         self.runtime = time.perf_counter() - start_time
         self.done = True
 
     def result_obj(self):
         return self._result_obj
+
+    def cheapest_triples(self, k: int) -> list[tuple[tuple, float]]:
+        """
+        The k triples (one item per section) of the menu with the smallest annealed cost, independently of the
+        selection.  Triples are annealed in increasing order of their lower surrogate (see TripleCostOracle.surrogates)
+        until the k-th smallest annealed cost is no larger than the next lower bound, which proves the top k.
+        @param k: Number of triples
+        @return: (item ids, cost) pairs, cheapest first.  With dedupe, nutritionally identical items only appear once
+        """
+        # One representative per identical group
+        sections = [list({item.id: item for item in items}.values()) for items in self._sections()[2]]
+        if k <= 0 or not all(sections):
+            return []
+        _, lower = self.oracle.surrogates(*sections)
+        best = []  # Max-heap (negated costs) of the k cheapest annealed triples so far
+        for flat in np.argsort(lower, axis=None, kind='stable'):
+            idx = np.unravel_index(flat, lower.shape)
+            if len(best) == k and -best[0][0] <= lower[idx]:
+                break
+            triple = tuple(items[i] for items, i in zip(sections, idx))
+            entry = -self.oracle.cost(*triple), tuple(item.id for item in triple)
+            if len(best) < k:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+        return [(ids, -neg_cost) for neg_cost, ids in sorted(best, reverse=True)]
+
+    def portions(self, item_ids: tuple) -> list[PlateSectionState]:
+        """
+        @param item_ids: (large id, small1 id, small2 id), e.g. one item of each section of result_obj()
+        @return: The plate sections at their annealed volumes.  Triples annealed by the search are not annealed again
+        """
+        _, sections, representatives = self._sections()
+        by_id = {item.id: rep for items, reps in zip(sections, representatives) for item, rep in zip(items, reps)}
+        by_id.update((item.id, item) for item in self.items if item.id not in by_id)
+        state = self.oracle.portions(*(by_id[item_id] for item_id in item_ids))
+        for s, item_id in zip(state, item_ids):
+            s.id = item_id
+        return state
+
+
+def requirement_key(profile: StudentProfileSpec, large_portion_max: float) -> tuple:
+    """
+    @return: Hashable key of everything a selection depends on besides the menu and the fixed parameters, i.e. profiles
+    with the same key can share triple costs and results
+    """
+    lo, hi = nutritional_info_for(profile)
+    layout = section_categories(profile.health_goal, large_portion_max)
+    return layout, tuple(lo.as_dict().values()), tuple(hi.as_dict().values())
+
+
+def run_selection(profile: StudentProfileSpec, items: list[MealItemSpec], params: dict, cost_cache: dict,
+                  solutions: dict):
+    """
+    Runs MealItemSelector, meant to be called in a worker process
+    @return: (result object, result cost, triple costs that were not in cost_cache, solutions that were not in
+    solutions)
+    """
+    selector = MealItemSelector(profile=profile, items=items, cost_cache=dict(cost_cache), solutions=dict(solutions),
+                                **params)
+    selector.run_algorithm()
+    new_costs = {key: cost for key, cost in selector.cost_cache.items() if key not in cost_cache}
+    new_solutions = {key: ratios for key, ratios in selector.solutions.items() if key not in solutions}
+    return selector.result_obj(), selector.result_cost, new_costs, new_solutions
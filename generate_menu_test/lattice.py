@@ -0,0 +1,200 @@
+import time
+from typing import Optional
+
+import numpy as np
+
+from common import NUTRITION_FIELDS
+from cost import Coefficients, coefficient_vector, nutrition_cost, nutrition_vector
+from portion import PlateSectionState, MealItemSpec
+from requirements import nutritional_info_for, StudentProfileSpec
+
+# Number of volumes tried per plate section, i.e. a triple is evaluated on a GRID_SIZE^3 lattice
+DEFAULT_GRID_SIZE = 8
+# Number of times the lattice is shrunk around the best point found so far
+DEFAULT_REFINE_ROUNDS = 2
+# Max number of floats held in memory at once
+BLOCK_ELEMENTS = 2 ** 23
+
+
+def section_arrays(states: list[list[PlateSectionState]], n: Optional[int] = None):
+    """
+    Converts plate states to the arrays used by lattice_solve
+    @param states: B states (each a list of n PlateSectionState, n being the same for all states)
+    @param n: Number of sections per state, defaults to the length of the first state (0 if there are no states)
+    @return: (unit nutrition (B, n, 16): nutrition per unit of volume, min volumes (B, n), max volumes (B, n),
+    discrete (B, n))
+    """
+    if n is None:
+        n = len(states[0]) if states else 0
+    flat = [section for state in states for section in state]
+    units = np.array([nutrition_vector(s.nutrition) / s.portion_volume for s in flat]).reshape(
+        len(states), n, len(NUTRITION_FIELDS))
+    v_min, v_max, discrete = (np.array(values).reshape(len(states), n) for values in (
+        [s.min_volume for s in flat], [s.max_volume for s in flat], [s.discrete for s in flat]))
+    return units, v_min.astype(np.float64), v_max.astype(np.float64), discrete.astype(bool)
+
+
+def triple_arrays(triples: list[tuple[MealItemSpec, ...]], container_volumes: tuple[float, ...]):
+    """
+    section_arrays for (large, small1, small2) MealItemSpec triples
+    @param triples: List of item tuples
+    @param container_volumes: Size of each plate section
+    @return: See section_arrays
+    """
+    return section_arrays([[PlateSectionState.from_item_spec(item, volume, 1, '')
+                            for item, volume in zip(triple, container_volumes)] for triple in triples])
+
+
+def _grids(v_lo: np.ndarray, v_hi: np.ndarray, discrete: np.ndarray, k: int) -> np.ndarray:
+    """
+    @return: (..., k) evenly spaced volumes between v_lo and v_hi, rounded to piece counts for discrete sections
+    """
+    grid = v_lo[..., None] + (v_hi - v_lo)[..., None] * np.linspace(0, 1, k)
+    return np.where(discrete[..., None], np.round(grid), grid)
+
+
+def _totals(grids: np.ndarray, units: np.ndarray) -> np.ndarray:
+    """
+    @param grids: (P, n, K) volumes of each section of each problem
+    @param units: (P, n, 16) nutrition per unit of volume
+    @return: (P, K^n, 16) nutrition totals at every lattice point
+    """
+    n_p, n, k = grids.shape
+    totals = np.zeros((n_p,) + (1,) * n + (units.shape[2],))
+    for s in range(n):
+        shape = [n_p] + [1] * n + [units.shape[2]]
+        shape[1 + s] = k
+        totals = totals + (grids[:, s, :, None] * units[:, s, None, :]).reshape(shape)
+    return totals.reshape(n_p, k ** n, -1)
+
+
+def _volumes_at(grids: np.ndarray, flat_idx: np.ndarray) -> np.ndarray:
+    """
+    @param grids: (P, n, K) section volumes
+    @param flat_idx: (..., P) flat lattice point indices
+    @return: (..., P, n) volumes at those lattice points
+    """
+    n_p, n, k = grids.shape
+    idx = np.unravel_index(flat_idx, (k,) * n)
+    return np.stack([np.take_along_axis(np.broadcast_to(grids[:, s], flat_idx.shape + (k,)), idx[s][..., None],
+                                        axis=-1)[..., 0] for s in range(n)], axis=-1)
+
+
+def lattice_totals(units: np.ndarray, v_min: np.ndarray, v_max: np.ndarray, discrete: np.ndarray,
+                   grid_size: int = DEFAULT_GRID_SIZE) -> np.ndarray:
+    """
+    Nutrition totals of plates at every point of their (unrefined) lattice.  They depend neither on the requirements
+    nor on the coefficients, so every coefficient configuration of a sweep can be evaluated on the same totals (see
+    sweep.py, where each worker computes them per chunk of triples)
+    @param units: (B, n, 16) nutrition per unit of volume, see section_arrays
+    @param v_min: (B, n) min volume of each section
+    @param v_max: (B, n) max volume of each section
+    @param discrete: (B, n) whether each section is discrete
+    @param grid_size: Volumes tried per section
+    @return: (B, grid_size^n, 16) totals
+    """
+    return _totals(_grids(v_min, v_max, discrete, grid_size), units)
+
+
+def lattice_solve(units: np.ndarray, v_min: np.ndarray, v_max: np.ndarray, discrete: np.ndarray,
+                  lo: np.ndarray, hi: np.ndarray, coefficients: Coefficients,
+                  grid_size: int = DEFAULT_GRID_SIZE, refine_rounds: int = DEFAULT_REFINE_ROUNDS):
+    """
+    Portion solver evaluating the cost on a lattice of section volumes, for many plates and requirement sets at once.
+    Each section is tried at grid_size volumes evenly spaced between its min and max volume (piece counts for discrete
+    sections), and the best lattice point is kept.  Each refinement round then evaluates a new lattice spanning one grid
+    step around the best point, so the precision grows by about (grid_size - 1) / 2 per round.  The result is
+    deterministic.
+    @param units: (B, n, 16) nutrition per unit of volume of each section of each plate, see section_arrays
+    @param v_min: (B, n) min volume of each section
+    @param v_max: (B, n) max volume of each section
+    @param discrete: (B, n) whether each section is discrete
+    @param lo: (G, 16) lower requirement bounds
+    @param hi: (G, 16) upper requirement bounds
+    @param coefficients: Nutrient weights, see cost.coefficient_vector
+    @param grid_size: Volumes tried per section per round
+    @param refine_rounds: Number of refinement rounds
+    @return: (costs (G, B), volumes (G, B, n)) of the best lattice point of every plate for every requirement set
+    """
+    weights = coefficient_vector(coefficients)
+    n_g, n_b, n = len(lo), len(units), units.shape[1]
+    k = grid_size
+    costs = np.empty((n_g, n_b))
+    volumes = np.empty((n_g, n_b, n))
+    per_problem = k ** n * len(NUTRITION_FIELDS)
+    step = max(1, BLOCK_ELEMENTS // per_problem)
+
+    # The first lattice does not depend on the requirements, so its totals are shared by every requirement set
+    g_step = max(1, BLOCK_ELEMENTS // (step * per_problem))
+    for b in range(0, n_b, step):
+        block = slice(b, b + step)
+        grids = _grids(v_min[block], v_max[block], discrete[block], k)
+        totals = _totals(grids, units[block])
+        for g in range(0, n_g, g_step):
+            group = slice(g, g + g_step)
+            lattice_costs = nutrition_cost(totals[None], lo[group, None, None], hi[group, None, None], weights)
+            best = lattice_costs.argmin(axis=2)
+            costs[group, block] = np.take_along_axis(lattice_costs, best[..., None], axis=2)[..., 0]
+            volumes[group, block] = _volumes_at(grids, best)
+
+    # Refinement rounds are specific to each (requirement set, plate) problem
+    spacing = np.broadcast_to((v_max - v_min) / max(1, k - 1), (n_g, n_b, n)).reshape(-1, n)
+    flat_costs, flat_volumes = costs.reshape(-1), volumes.reshape(-1, n)
+    plate = np.tile(np.arange(n_b), n_g)
+    group_of = np.repeat(np.arange(n_g), n_b)
+    for _ in range(refine_rounds):
+        spacing = np.where(discrete[plate], np.maximum(spacing, 1), spacing)
+        for p in range(0, len(flat_costs), step):
+            block = slice(p, p + step)
+            b_idx, g_idx = plate[block], group_of[block]
+            grids = _grids(np.maximum(v_min[b_idx], flat_volumes[block] - spacing[block]),
+                           np.minimum(v_max[b_idx], flat_volumes[block] + spacing[block]), discrete[b_idx], k)
+            lattice_costs = nutrition_cost(_totals(grids, units[b_idx]), lo[g_idx, None], hi[g_idx, None], weights)
+            best = lattice_costs.argmin(axis=1)
+            best_costs = lattice_costs[np.arange(len(best)), best]
+            better = best_costs < flat_costs[block]
+            flat_costs[block] = np.where(better, best_costs, flat_costs[block])
+            flat_volumes[block] = np.where(better[:, None], _volumes_at(grids, best), flat_volumes[block])
+        spacing = 2 * spacing / max(1, k - 1)
+
+    return flat_costs.reshape(n_g, n_b), flat_volumes.reshape(n_g, n_b, n)
+
+
+class LatticeSolver:
+    def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState], coefficients: Coefficients,
+                 grid_size: int = DEFAULT_GRID_SIZE, refine_rounds: int = DEFAULT_REFINE_ROUNDS):
+        """
+        Deterministic alternative to SimulatedAnnealing with the same interface, see lattice_solve
+        @param profile: The student
+        @param state: Plate sections, their volumes are ignored
+        @param coefficients: Nutrient weights, see cost.coefficient_vector
+        @param grid_size: Volumes tried per section per round
+        @param refine_rounds: Number of refinement rounds
+        """
+        self.lo_req, self.hi_req = nutritional_info_for(profile)
+        self.coefficients = coefficients
+        self.grid_size = grid_size
+        self.refine_rounds = refine_rounds
+        self.state = state
+
+        # Result properties
+        self.done = False
+        self.final_cost = -1
+        self.runtime = -1
+
+    def run_algorithm(self):
+        """
+        Runs the algorithm
+        @return: None, the best volumes are stored in self.state and the cost in self.final_cost
+        """
+        start_time = time.perf_counter()
+        costs, volumes = lattice_solve(*section_arrays([self.state]),
+                                       nutrition_vector(self.lo_req)[None], nutrition_vector(self.hi_req)[None],
+                                       self.coefficients, self.grid_size, self.refine_rounds)
+        self.state = [s.copy() for s in self.state]
+        for s, volume in zip(self.state, volumes[0, 0]):
+            s.volume = int(volume) if s.discrete else float(volume)
+
+        self.runtime = time.perf_counter() - start_time
+        self.final_cost = float(costs[0, 0])
+        self.done = True
@@ -0,0 +1,111 @@
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Optional, Union
+
+from common import MEALS
+from item_choice import DEFAULT_PARAMS, requirement_key, run_selection
+from portion import MealItemSpec
+from requirements import StudentProfileSpec
+
+# Meal(s) an item is served at: a function of the item, or a dict of item id -> meal(s).  Several meals can be given as
+# a list/tuple/set
+MealOf = Union[Callable[[MealItemSpec], object], dict]
+
+
+def partition_items(items: list[MealItemSpec], meal_of: Optional[MealOf] = None) -> dict:
+    """
+    Splits a catalog into (cafeteria_id, meal) partitions.  MealItemSpec has no meal, so it is given by meal_of
+    @param items: The catalog
+    @param meal_of: Meal(s) each item is served at (one of MEALS), see MealOf.  Items without a meal are left out.  If
+    None, the catalog is only split by cafeteria, and the meal of every key is None
+    @return: dict of (cafeteria_id, meal) -> items served there, in catalog order
+    """
+    partitions = defaultdict(list)
+    for item in items:
+        if meal_of is None:
+            meals = [None]
+        else:
+            meals = meal_of.get(item.id) if isinstance(meal_of, dict) else meal_of(item)
+            if meals is None:
+                continue
+            if isinstance(meals, str):
+                meals = [meals]
+        for meal in meals:
+            if meal is not None and meal not in MEALS:
+                raise ValueError(f'Unknown meal {meal} for item {item.id}')
+            partitions[item.cafeteria_id, meal].append(item)
+    return dict(partitions)
+
+
+class PartitionedSelector:
+    def __init__(self, items: list[MealItemSpec], meal_of: Optional[MealOf] = None, params: Optional[dict] = None,
+                 meal_params: Optional[dict] = None, max_workers: Optional[int] = None):
+        """
+        Runs the item selection separately for every (cafeteria, meal) partition of a catalog (see partition_items), as
+        independent jobs on a process pool.  Each partition keeps its own triple costs and solutions per requirement
+        set, which later runs on the same partition reuse.
+        @param items: The catalog
+        @param meal_of: Meal(s) each item is served at, see partition_items
+        @param params: MealItemSelector parameters, defaults to item_choice.DEFAULT_PARAMS
+        @param meal_params: Optional dict of meal -> parameters overriding params for that meal's partitions (e.g.
+        {BREAKFAST: dict(large_portion_max=0)})
+        @param max_workers: Size of the process pool, defaults to the number of CPUs
+        """
+        self.partitions = partition_items(items, meal_of)
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.meal_params = meal_params or {}
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+
+        # partition -> requirement key -> (costs, solutions)
+        self.cost_caches = {partition: {} for partition in self.partitions}
+        self.runtime = -1
+
+    def close(self):
+        self.pool.shutdown()
+
+    def params_for(self, partition: tuple) -> dict:
+        """
+        @param partition: (cafeteria_id, meal) key
+        @return: MealItemSelector parameters of the partition
+        """
+        return dict(self.params, **self.meal_params.get(partition[1], {}))
+
+    def run(self, profiles: list[StudentProfileSpec], partitions: Optional[list] = None) -> dict:
+        """
+        Chooses the items of every partition for every student.  Students with the same requirements (see
+        item_choice.requirement_key) share one job per partition
+        @param profiles: The students
+        @param partitions: Keys of the partitions to run, defaults to all of them
+        @return: dict of (partition, student position in profiles) -> dict with the MealItemSelector result object
+        ('result') and its cost ('cost')
+        """
+        start_time = time.perf_counter()
+        partitions = list(self.partitions) if partitions is None else partitions
+        for partition in partitions:
+            if partition not in self.partitions:
+                raise ValueError(f'Unknown partition {partition}')
+
+        futures = {}
+        for partition in partitions:
+            params = self.params_for(partition)
+            groups = defaultdict(list)
+            for idx, profile in enumerate(profiles):
+                groups[requirement_key(profile, params['large_portion_max'])].append(idx)
+            for req_key, idxs in groups.items():
+                costs, solutions = self.cost_caches[partition].setdefault(req_key, ({}, {}))
+                future = self.pool.submit(run_selection, profiles[idxs[0]], self.partitions[partition], params,
+                                          costs, solutions)
+                futures[future] = partition, req_key, idxs
+
+        results = {}
+        for future in as_completed(futures):
+            partition, req_key, idxs = futures[future]
+            result_obj, cost, new_costs, new_solutions = future.result()
+            costs, solutions = self.cost_caches[partition][req_key]
+            costs.update(new_costs)
+            solutions.update(new_solutions)
+            for idx in idxs:
+                results[partition, idx] = dict(result=result_obj, cost=cost)
+        self.runtime = time.perf_counter() - start_time
+        return results
@@ -4,9 +4,12 @@ import random
 import time
 from dataclasses import dataclass
 from math import exp
-from typing import Union
+from typing import Optional, Union
+
+import numpy as np
 
 from common import Nutrition
+from cost import Coefficients, coefficient_vector, nutrition_cost, nutrition_vector
 from requirements import nutritional_info_for, StudentProfileSpec
 
 
@@ -229,46 +232,47 @@ def nutrition_of(state: list[PlateSectionState]):
     return res
 
 
-DEFAULT_COEFFICIENTS = [
-    100000, #1,  # Calories
-    8,  # Carbohydrate
-    20,  # Protein
-    50,  # Total fat
-    1.5 * 50,  # Saturated fat
-    50,  # Trans fat
+# Weight of each nutrient in the cost, see cost.nutrition_cost
+DEFAULT_COEFFICIENTS = Nutrition(
+    calories=100000,  # 1,
+    carbohydrate=8,
+    protein=20,
+    total_fat=50,
+    saturated_fat=1.5 * 50,
+    trans_fat=50,
+)
 
-    0,  # Sugar
-    0,  # Cholesterol
-    0,  # Fiber
-    0,  # Sodium
-    0,  # Potassium
-    0,  # Calcium
-    0,  # Iron
 
-    0,  # Vitamin C
-    0,  # Vitamin D
-    0,  # Vitamin A
-]
+# Initial temperature of simulated annealing, we only take half to full filled anyway
+INITIAL_TEMP = 0.5
 
 
 # Source: https://en.wikipedia.org/wiki/Simulated_annealing#Overview
 # https://codeforces.com/blog/entry/94437
 class SimulatedAnnealing:
     def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState],
-                 coefficients: tuple[float], alpha: float, smallest_temp: float, seed: int):
+                 coefficients: Coefficients, alpha: float, smallest_temp: float, seed: int,
+                 initial_volumes: Optional[list[Union[float, int]]] = None, initial_temp: float = INITIAL_TEMP,
+                 keep_best: bool = False):
         """
         Creates a SimulatedAnnealing object which can run the portion-selecting algorithm
         @param
         @param state: Initial algorithm state, as a list of PlateSectionState.  For the purposes of data analysis of
         algorithm performance, each element can be constructed using the first four parameters with the rest being in
         their default state.
-        @param coefficients: List of weights denoting how much each nutrient is weighted.  The cost of a state is
-        determined by the distance of its nutrition facts to the 'allowed' range.  Euclidian distance**2 is the metric
-        used to measure how far each nutrient is from its goal.  These are then scaled by the individual coefficients.
-        See self.cost_of for more details on which coefficient affects what.
+        @param coefficients: Weights denoting how much each nutrient is weighted, keyed by nutrient (a Nutrition
+        object or dict, see cost.coefficient_vector).  The cost of a state is determined by the distance of its
+        nutrition facts to the 'allowed' range.  Euclidian distance**2 is the metric used to measure how far each
+        nutrient is from its goal.  These are then scaled by the individual coefficients.
         @param alpha: Amount temperature is multiplied by after each iteration
         @param smallest_temp: Minimal temperature before algorithm termination.
         @param seed: Seed value of RNG to make run deterministic.  -1 means no set seed
+        @param initial_volumes: Volume of each section to start from (clamped to the allowed range), instead of the
+        mid volumes.  Used to warm-start from the solution of a similar state, usually along with a lower initial_temp
+        @param initial_temp: Starting temperature, i.e. the largest nudge as a ratio of the max volume
+        @param keep_best: Whether to end in the best state visited instead of the last one.  Short (warm-started) runs
+        need this, since the acceptance probability is scaled by the worst possible cost and so even low temperatures
+        accept moves that are large compared to the cost of a good state
         """
         # Info properties
         self.lo_req, self.hi_req = nutritional_info_for(profile)
@@ -278,6 +282,14 @@ class SimulatedAnnealing:
         self.alpha = alpha
         self.smallest_temp = smallest_temp
         self.coefficients = coefficients
+        self.initial_volumes = initial_volumes
+        self.initial_temp = initial_temp
+        self.keep_best = keep_best
+
+        # Vectorized cost parameters: bounds, weights, and nutrition per unit of volume of each section
+        self._lo, self._hi = nutrition_vector(self.lo_req), nutrition_vector(self.hi_req)
+        self._weights = coefficient_vector(coefficients)
+        self._unit_nutrition = np.array([nutrition_vector(s.nutrition) / s.portion_volume for s in state])
 
         # State properties
         self.t = 1
@@ -307,6 +319,18 @@ class SimulatedAnnealing:
         """
         return [state.with_max_volume() for state in self.state]
 
+    def initial_state(self):
+        """
+        @return: Copies the current state except state[i].volume is at initial_volumes[i] (clamped, and rounded for
+        discrete sections), or at the middle value if there are no initial volumes
+        """
+        if self.initial_volumes is None:
+            return self.mid_state()
+        ret = [state.copy() for state in self.state]
+        for s, volume in zip(ret, self.initial_volumes):
+            s.volume = clamp(int(round(volume)) if s.discrete else volume, s.min_volume, s.max_volume)
+        return ret
+
     def nudge(self, t):
         """
         Nudges self.state to a random neighbour based on a given temperature
@@ -325,27 +349,13 @@ class SimulatedAnnealing:
 
     def cost_of(self, state):
         """
-        Given a state, returns its cost, which is based on the current nutritional limits (upper and lower).
-        @param state: Self-explanatory
+        Given a state, returns its cost, which is based on the current nutritional limits (upper and lower).  See
+        cost.nutrition_cost.
+        @param state: Self-explanatory, must have the same sections (in the same order) as self.state
         @return: Self-explanatory
         """
-        cur_info = nutrition_of(state)
-        return self.coefficients[0] * dist_sq(cur_info.calories, self.lo_req.calories, self.hi_req.calories) + \
-               self.coefficients[1] * dist_sq(cur_info.carbohydrate, self.lo_req.carbohydrate, self.hi_req.carbohydrate) + \
-               self.coefficients[2] * dist_sq(cur_info.protein, self.lo_req.protein, self.hi_req.protein) + \
-               self.coefficients[3] * dist_sq(cur_info.total_fat, self.lo_req.total_fat, self.hi_req.total_fat) + \
-               self.coefficients[4] * dist_sq(cur_info.saturated_fat, self.lo_req.saturated_fat, self.hi_req.saturated_fat) + \
-               self.coefficients[5] * dist_sq(cur_info.trans_fat, self.lo_req.trans_fat, self.hi_req.trans_fat) + \
-               self.coefficients[5] * dist_sq(cur_info.sugar, self.lo_req.sugar, self.hi_req.sugar) + \
-               self.coefficients[6] * dist_sq(cur_info.cholesterol, self.lo_req.cholesterol, self.hi_req.cholesterol) + \
-               self.coefficients[7] * dist_sq(cur_info.fiber, self.lo_req.fiber, self.hi_req.fiber) + \
-               self.coefficients[8] * dist_sq(cur_info.sodium, self.lo_req.sodium, self.hi_req.sodium) + \
-               self.coefficients[9] * dist_sq(cur_info.potassium, self.lo_req.potassium, self.hi_req.potassium) + \
-               self.coefficients[10] * dist_sq(cur_info.calcium, self.lo_req.calcium, self.hi_req.calcium) + \
-               self.coefficients[11] * dist_sq(cur_info.iron, self.lo_req.iron, self.hi_req.iron) + \
-               self.coefficients[12] * dist_sq(cur_info.vitamin_c, self.lo_req.vitamin_c, self.hi_req.vitamin_c) + \
-               self.coefficients[13] * dist_sq(cur_info.vitamin_d, self.lo_req.vitamin_d, self.hi_req.vitamin_d) + \
-               self.coefficients[14] * dist_sq(cur_info.vitamin_a, self.lo_req.vitamin_a, self.hi_req.vitamin_a)
+        volumes = np.array([s.volume for s in state], dtype=np.float64)
+        return float(nutrition_cost(volumes @ self._unit_nutrition, self._lo, self._hi, self._weights))
 
     def accept_probability_of(self, c_new: float, c_old: float, scale_coeff: float):
         """
@@ -370,21 +380,28 @@ class SimulatedAnnealing:
         # Initialization
         cost_bound = max(self.cost_of(self.lo_state()), self.cost_of(self.hi_state()))
         scale_cost_by = 60 / (cost_bound + 0.0001)  # special case when cost_bound == 0
-        self.state = self.mid_state()
+        self.state = self.initial_state()
 
         # Run algorithm
         start_time = time.perf_counter()
-        t = 0.5  # Initial Temp, we only take half to full filled anyway
+        t = self.initial_temp
+        best_cost, best_volumes = self.cost_of(self.state), [s.volume for s in self.state]
         while t >= self.smallest_temp:
             c_old = self.cost_of(self.state)
             self.nudge(t)
             c_new = self.cost_of(self.state)
             if self.accept_probability_of(c_new, c_old, scale_cost_by) < random.random():
                 self.un_nudge()  # undo the nudge if it failed
+            elif self.keep_best and c_new < best_cost:
+                best_cost, best_volumes = c_new, [s.volume for s in self.state]
 
             # update tmp
             t *= self.alpha
 
+        if self.keep_best:
+            for s, volume in zip(self.state, best_volumes):
+                s.volume = volume
+
         # Set result vars
         self.runtime = time.perf_counter() - start_time
         self.final_cost = self.cost_of(self.state)
@@ -84,6 +84,9 @@ MACROS_COEFF = {
 # Max portion sizes and min fill requirement, in ML
 CALS_IN_FAT = 9
 
+# Daily requirements are split evenly between this many meals
+MEALS_PER_DAY = 3
+
 
 # ProfileSpec
 @dataclass
@@ -99,7 +102,25 @@ class StudentProfileSpec:
     activity_level: str
 
 
-def nutritional_info_for(profile: StudentProfileSpec) -> tuple[Nutrition, Nutrition]:
+def profile_from_dict(obj: dict) -> StudentProfileSpec:
+    """
+    Creates a StudentProfileSpec from a student in the format of fake_person.json / the summary CSVs
+    @param obj: dict with Sex, Height, Weight, Birthdate (ISO format), Health_Goal and Activity_Level keys
+    @return: The profile
+    """
+    return StudentProfileSpec(
+        height=float(obj['Height']),
+        weight=float(obj['Weight']),
+        birthdate=datetime.date.fromisoformat(obj['Birthdate']),
+        meals=list(obj.get('Meals', [])),
+        meal_length=float(obj.get('Meal_Length', 0)),
+        sex=obj['Sex'],
+        health_goal=obj['Health_Goal'],
+        activity_level=obj['Activity_Level']
+    )
+
+
+def daily_nutritional_info_for(profile: StudentProfileSpec) -> tuple[Nutrition, Nutrition]:
     for req_prop in ('activity_level', 'sex', 'weight', 'height', 'birthdate'):
         if not hasattr(profile, req_prop):
             raise ValueError(f'Student profile missing attribute {req_prop}')
@@ -132,9 +153,15 @@ def nutritional_info_for(profile: StudentProfileSpec) -> tuple[Nutrition, Nutrit
     lo.saturated_fat = sat_fat[0] * calories / CALS_IN_FAT
     hi.saturated_fat = sat_fat[1] * calories / CALS_IN_FAT
 
+    return lo, hi
+
+
+def nutritional_info_for(profile: StudentProfileSpec) -> tuple[Nutrition, Nutrition]:
+    lo, hi = daily_nutritional_info_for(profile)
+
     # Divide reqs by 3 since these are daily
     for prop in DEFAULT_HI_REQS.keys():  # Doesn't matter if hi or lo
-        setattr(lo, prop, getattr(lo, prop) / 3)
-        setattr(hi, prop, getattr(hi, prop) / 3)
+        setattr(lo, prop, getattr(lo, prop) / MEALS_PER_DAY)
+        setattr(hi, prop, getattr(hi, prop) / MEALS_PER_DAY)
 
     return lo, hi
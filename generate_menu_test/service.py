@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from catalog import identical_groups, load_items, NUTRITION_TABLE_PATH
+from item_choice import DEFAULT_PARAMS, MealItemSelector, requirement_key, run_selection
+from portion import MealItemSpec
+from requirements import profile_from_dict, StudentProfileSpec
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Max number of distinct requirement sets whose triple costs are kept, and of cached (profile, menu) results
+MAX_COST_CACHES = 256
+MAX_RESULTS = 4096
+
+
+def _portions(profile: StudentProfileSpec, items: list[MealItemSpec], params: dict, solutions: dict):
+    """
+    Anneals one plate in a worker process, warm-started from the known solutions
+    @return: (plate sections, fill ratios of the plate)
+    """
+    selector = MealItemSelector(profile=profile, items=items, solutions=dict(solutions), **params)
+    key = tuple(item.id for item in items)
+    return selector.portions(key), selector.solutions[key]
+
+
+class MenuService:
+    def __init__(self, items: list[MealItemSpec], params: Optional[dict] = None, max_workers: Optional[int] = None):
+        """
+        Long-running wrapper around MealItemSelector which keeps the item catalog, requirements and annealed triple
+        costs in memory between requests.  Selections run in a process pool, and concurrent requests for the same
+        (requirements, menu) pair are coalesced into one run.
+        @param items: The item catalog, menus are given as lists of ids into it
+        @param params: MealItemSelector parameters (portion sizes, coefficients, annealing parameters), defaults to
+        DEFAULT_PARAMS
+        @param max_workers: Size of the process pool, defaults to the number of CPUs
+        """
+        self.items = {item.id: item for item in items}
+        # Item id -> ids of the nutritionally identical items, representative first (see MealItemSelector's dedupe)
+        self.copies = {item.id: [copy.id for copy in group] for group in identical_groups(items) for item in group}
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+
+        # Triple costs and solutions only depend on the requirements (and the fixed params), so they are shared between
+        # students.  Each entry is a (costs, solutions) pair of dicts
+        self._cost_caches: OrderedDict = OrderedDict()
+        self._results: OrderedDict = OrderedDict()
+        self._in_flight: dict = {}
+        self.stats = dict(requests=0, result_hits=0, coalesced=0, runs=0)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def requirement_key(self, profile: StudentProfileSpec) -> tuple:
+        """
+        @return: Hashable key of everything the selection depends on besides the menu
+        """
+        return requirement_key(profile, self.params['large_portion_max'])
+
+    def _cost_cache_for(self, key: tuple) -> tuple[dict, dict]:
+        if key in self._cost_caches:
+            self._cost_caches.move_to_end(key)
+        else:
+            self._cost_caches[key] = {}, {}
+            if len(self._cost_caches) > MAX_COST_CACHES:
+                self._cost_caches.popitem(last=False)
+        return self._cost_caches[key]
+
+    async def select(self, profile: StudentProfileSpec, menu: list) -> dict:
+        """
+        Chooses the items of a menu for a student
+        @param profile: The student
+        @param menu: Ids of the items available at the meal
+        @return: dict with the MealItemSelector result object ('result'), its cost ('cost') and whether it was served
+        from cache ('cached')
+        """
+        self.stats['requests'] += 1
+        for item_id in menu:
+            if item_id not in self.items:
+                raise ValueError(f'Unknown item id {item_id}')
+
+        req_key = self.requirement_key(profile)
+        key = req_key, tuple(sorted(set(menu)))
+        if key in self._results:
+            self.stats['result_hits'] += 1
+            self._results.move_to_end(key)
+            return dict(self._results[key], cached=True)
+        if key in self._in_flight:
+            self.stats['coalesced'] += 1
+            return dict(await asyncio.shield(self._in_flight[key]), cached=True)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            self.stats['runs'] += 1
+            menu_items = [self.items[item_id] for item_id in key[1]]
+            cost_cache, solutions = self._cost_cache_for(req_key)
+            sections = [[item.id for item in menu_items if item.category == category] for category in req_key[0]]
+            triples = list(itertools.product(*sections))
+            known = {triple: cost_cache[triple] for triple in triples if triple in cost_cache}
+            known_solutions = {triple: solutions[triple] for triple in triples if triple in solutions}
+            result_obj, cost, new_costs, new_solutions = await asyncio.get_running_loop().run_in_executor(
+                self.pool, run_selection, profile, menu_items, self.params, known, known_solutions)
+            cost_cache.update(new_costs)
+            solutions.update(new_solutions)
+
+            result = dict(result=result_obj, cost=cost)
+            self._results[key] = result
+            if len(self._results) > MAX_RESULTS:
+                self._results.popitem(last=False)
+            future.set_result(result)
+            return dict(result, cached=False)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved, so requests without waiters don't log it
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def portions(self, profile: StudentProfileSpec, plate: list) -> list[dict]:
+        """
+        Portions of a chosen plate, served from the solutions of earlier selections when possible
+        @param profile: The student
+        @param plate: Ids of the large, small1 and small2 items, usually taken from a select() result
+        @return: One dict per section with the item id, section name and volume (negative piece count for discrete
+        items, as in the DB)
+        """
+        if len(plate) != 3:
+            raise ValueError(f'Expected 3 items, got {len(plate)}')
+        for item_id in plate:
+            if item_id not in self.items:
+                raise ValueError(f'Unknown item id {item_id}')
+
+        _, solutions = self._cost_cache_for(self.requirement_key(profile))
+        # Selections can return copies of the items their solutions are stored under, so any combination of copies of
+        # the plate's items is the same plate
+        copies = [self.copies[item_id] for item_id in plate]
+        key = next((triple for triple in itertools.product(*copies) if triple in solutions), None)
+        if key is not None:
+            items = [self.items[item_id] for item_id in key]
+            selector = MealItemSelector(profile=profile, items=items, solutions={key: solutions[key]}, **self.params)
+            state = selector.portions(key)
+        else:
+            key = tuple(ids[0] for ids in copies)
+            items = [self.items[item_id] for item_id in key]
+            groups = [set(ids) for ids in copies]
+            known = {tuple(rep if item_id in group else item_id for item_id, group, rep in zip(triple, groups, key)):
+                     ratios for triple, ratios in solutions.items()
+                     if sum(item_id in group for item_id, group in zip(triple, groups)) == 2}
+            state, solutions[key] = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _portions, profile, items, self.params, known)
+        for s, item_id in zip(state, plate):
+            s.id = item_id
+        return [dict(id=s.id, section=s.section_name, volume=s.format_volume()) for s in state]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves one client.  Requests and responses are JSON objects, one per line.  A request looks like
+        {"profile": <student in fake_person.json format>, "menu": [<item ids>]}, {"profile": ..., "plate": [<large id>,
+        <small1 id>, <small2 id>]} returns the portions of a plate, and {"stats": true} returns the cache statistics.
+        """
+        try:
+            while line := await reader.readline():
+                start_time = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                    if request.get('stats'):
+                        response = dict(self.stats)
+                    elif 'plate' in request:
+                        response = dict(portions=await self.portions(profile_from_dict(request['profile']),
+                                                                     request['plate']))
+                    else:
+                        response = await self.select(profile_from_dict(request['profile']), request['menu'])
+                    response['runtime'] = time.perf_counter() - start_time
+                except Exception as e:
+                    response = dict(error=f'{type(e).__name__}: {e}')
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(service: MenuService, host: str, port: int):
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f'Serving on {host}:{port} with {len(service.items)} items')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Menu recommendation daemon (JSON lines over TCP)')
+    parser.add_argument('--items', default=NUTRITION_TABLE_PATH, help='Path to nutrition_table.csv')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None, help='Process pool size (default: # of CPUs)')
+    args = parser.parse_args()
+
+    service = MenuService(load_items(args.items), max_workers=args.workers)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        print('Exiting...')
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import csv
+import re
+import zlib
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+
+from catalog import nutrition_matrix
+from portion import MealItemSpec
+
+# Number of neighbours kept per item
+DEFAULT_K = 10
+# Rows of the pairwise distance matrix computed at a time (block of BLOCK_SIZE x N floats)
+BLOCK_SIZE = 1024
+# Number of hashed buckets used to embed item names
+NAME_BUCKETS = 64
+
+
+def name_vector(name: str, buckets: int = NAME_BUCKETS) -> np.ndarray:
+    """
+    Embeds an item name as a unit-length hashed bag of lowercase word tokens, so the dot product of two embeddings
+    approximates the cosine similarity of their token sets.
+    @param name: Item name
+    @param buckets: Embedding dimension
+    @return: (buckets,) float array
+    """
+    vec = np.zeros(buckets)
+    for token in re.findall(r'[a-z0-9]+', name.lower()):
+        vec[zlib.crc32(token.encode()) % buckets] += 1
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+def _merge_top_k(idx_a, dist_a, idx_b, dist_b, k):
+    """
+    Merges two candidate neighbour lists per row and keeps the k closest.  Missing entries have index -1 and
+    distance inf.
+    """
+    idx = np.concatenate((idx_a, idx_b), axis=1)
+    dist = np.concatenate((dist_a, dist_b), axis=1)
+    if idx.shape[1] > k:
+        part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        idx = np.take_along_axis(idx, part, axis=1)
+        dist = np.take_along_axis(dist, part, axis=1)
+    order = np.argsort(dist, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(dist, order, axis=1)
+
+
+class SimilarityIndex:
+    def __init__(self, k: int = DEFAULT_K, name_weight: float = 0., block_size: int = BLOCK_SIZE):
+        """
+        Sparse top-k nearest neighbour index over item nutrition facts (and optionally names).  Only the k nearest
+        neighbours of every item are stored, as two (n, k) arrays, so memory is linear in the number of items instead of
+        quadratic like a dense score table.
+
+        Nutrients are standardized (z-scored) with the statistics of the items the index is built from; these
+        statistics are then frozen, so inserting items later does not change the distances between existing items.
+        @param k: Number of neighbours to keep per item
+        @param name_weight: Weight of the name embedding relative to the (standardized) nutrient vector.  0 means names
+        are ignored.
+        @param block_size: Number of rows of the distance matrix computed at once
+        """
+        self.k = k
+        self.name_weight = name_weight
+        self.block_size = block_size
+
+        self.ids: list = []
+        self._pos: dict = {}
+        self._mean: Optional[np.ndarray] = None
+        self._scale: Optional[np.ndarray] = None
+        self._features = np.zeros((0, 0))
+        self._sq_norms = np.zeros(0)
+        # Neighbour positions (-1 = none) and their distances (inf = none), sorted by distance
+        self._neighbours = np.zeros((0, k), dtype=np.int32)
+        self._dists = np.zeros((0, k), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _featurize(self, items: list[MealItemSpec], names: Optional[list[str]]) -> np.ndarray:
+        """
+        @return: Feature matrix of the items, using the frozen standardization statistics
+        """
+        x = (nutrition_matrix(items) - self._mean) / self._scale
+        if self.name_weight > 0:
+            if names is None:
+                raise ValueError('name_weight > 0 but no names were given')
+            embedded = np.array([name_vector(name) for name in names]).reshape(len(items), -1)
+            x = np.hstack((x, self.name_weight * embedded))
+        return x
+
+    def _top_k(self, queries: np.ndarray, q_offset: int, targets: np.ndarray, t_sq_norms: np.ndarray, t_offset: int):
+        """
+        Blocked k-nearest search of the query rows among the target rows, excluding each row itself (rows are matched
+        by their global positions q_offset + i and t_offset + j).
+        @return: (neighbour positions, distances) arrays of shape (len(queries), min(k, len(targets)))
+        """
+        n_q, n_t = len(queries), len(targets)
+        k = min(self.k, n_t)
+        idx = np.full((n_q, k), -1, dtype=np.int32)
+        dist = np.full((n_q, k), np.inf, dtype=np.float32)
+        if k == 0:
+            return idx, dist
+
+        for start in range(0, n_q, self.block_size):
+            block = queries[start:start + self.block_size]
+            # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+            d = (block ** 2).sum(axis=1)[:, None] + t_sq_norms[None, :] - 2 * block @ targets.T
+            np.maximum(d, 0, out=d)
+            rows = np.arange(len(block))
+            self_cols = q_offset + start + rows - t_offset
+            mask = (self_cols >= 0) & (self_cols < n_t)
+            d[rows[mask], self_cols[mask]] = np.inf
+
+            part = np.argpartition(d, k - 1, axis=1)[:, :k] if k < n_t else np.tile(np.arange(n_t), (len(block), 1))
+            part_d = np.take_along_axis(d, part, axis=1)
+            order = np.argsort(part_d, axis=1, kind='stable')
+            part = np.take_along_axis(part, order, axis=1)
+            part_d = np.take_along_axis(part_d, order, axis=1)
+            part[np.isinf(part_d)] = -1 - t_offset
+            idx[start:start + len(block)] = part + t_offset
+            dist[start:start + len(block)] = np.sqrt(part_d)
+        return idx, dist
+
+    def build(self, items: list[MealItemSpec], names: Optional[list[str]] = None):
+        """
+        (Re)builds the index from scratch
+        @param items: Items to index, ids must be unique
+        @param names: Item names, parallel to items (only needed when name_weight > 0)
+        @return: self
+        """
+        raw = nutrition_matrix(items)
+        self._mean = raw.mean(axis=0) if len(items) else np.zeros(raw.shape[1])
+        scale = raw.std(axis=0) if len(items) else np.ones(raw.shape[1])
+        self._scale = np.where(scale > 0, scale, 1.)
+
+        self.ids = [item.id for item in items]
+        self._pos = {item_id: i for i, item_id in enumerate(self.ids)}
+        self._features = self._featurize(items, names)
+        self._sq_norms = (self._features ** 2).sum(axis=1)
+        idx, dist = self._top_k(self._features, 0, self._features, self._sq_norms, 0)
+        self._neighbours, self._dists = self._pad(idx, dist)
+        return self
+
+    def _pad(self, idx, dist):
+        """
+        Pads neighbour lists to exactly k columns
+        """
+        missing = self.k - idx.shape[1]
+        if missing > 0:
+            idx = np.hstack((idx, np.full((len(idx), missing), -1, dtype=np.int32)))
+            dist = np.hstack((dist, np.full((len(dist), missing), np.inf, dtype=np.float32)))
+        return idx.astype(np.int32), dist.astype(np.float32)
+
+    def insert(self, items: list[MealItemSpec], names: Optional[list[str]] = None):
+        """
+        Adds new items to the index without recomputing it.  Only the distances between the new items and all items
+        are computed, i.e. O(m * n) work for m new items instead of O(n^2).
+        @param items: New items, their ids must not already be in the index
+        @param names: Item names, parallel to items (only needed when name_weight > 0)
+        @return: self
+        """
+        if self._mean is None:
+            return self.build(items, names)
+        for item in items:
+            if item.id in self._pos:
+                raise ValueError(f'Item {item.id} is already in the index')
+
+        n_old = len(self.ids)
+        new_features = self._featurize(items, names)
+        new_sq_norms = (new_features ** 2).sum(axis=1)
+        all_features = np.vstack((self._features, new_features))
+        all_sq_norms = np.concatenate((self._sq_norms, new_sq_norms))
+
+        # Neighbours of the new items, among everything
+        new_idx, new_dist = self._pad(*self._top_k(new_features, n_old, all_features, all_sq_norms, 0))
+        # Existing items can only gain new items as neighbours
+        cand_idx, cand_dist = self._top_k(self._features, 0, new_features, new_sq_norms, n_old)
+        old_idx, old_dist = _merge_top_k(self._neighbours, self._dists, cand_idx, cand_dist, self.k)
+
+        self.ids.extend(item.id for item in items)
+        self._pos.update((item.id, n_old + i) for i, item in enumerate(items))
+        self._features = all_features
+        self._sq_norms = all_sq_norms
+        self._neighbours = np.vstack((old_idx, new_idx)).astype(np.int32)
+        self._dists = np.vstack((old_dist, new_dist)).astype(np.float32)
+        return self
+
+    def neighbours(self, item_id) -> list[tuple]:
+        """
+        @param item_id: Id of an indexed item
+        @return: List of (neighbour id, similarity score), most similar first.  Scores are 1 / (1 + distance), so they
+        are in (0, 1] with 1 meaning identical.
+        """
+        i = self._pos[item_id]
+        return [(self.ids[j], float(1 / (1 + d))) for j, d in zip(self._neighbours[i], self._dists[i]) if j >= 0]
+
+    def records(self):
+        """
+        @return: Generator of (id, neighbour id, similarity score) triplets, i.e. the index in coordinate format
+        """
+        for item_id in self.ids:
+            for neighbour_id, score in self.neighbours(item_id):
+                yield item_id, neighbour_id, score
+
+    def save_csv(self, path: str):
+        """
+        Writes the index in coordinate format, one (id, neighbour, score) row per stored pair
+        @param path: Output path
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('id', 'neighbour', 'score'))
+            writer.writerows(self.records())
+
+
+def build_category_indices(items: list[MealItemSpec], names: Optional[dict] = None, k: int = DEFAULT_K,
+                           name_weight: float = 0.) -> dict:
+    """
+    Builds one SimilarityIndex per item category, which is how the tables in similar/ are split
+    @param items: All items
+    @param names: dict of item id -> name (only needed when name_weight > 0)
+    @param k: Number of neighbours to keep per item
+    @param name_weight: See SimilarityIndex
+    @return: dict of category -> SimilarityIndex
+    """
+    by_category = defaultdict(list)
+    for item in items:
+        by_category[item.category].append(item)
+
+    return {category: SimilarityIndex(k=k, name_weight=name_weight).build(
+        cat_items, [names[item.id] for item in cat_items] if names is not None else None)
+        for category, cat_items in by_category.items()}
@@ -0,0 +1,209 @@
+import csv
+import itertools
+import math
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from common import NUTRITION_FIELDS, SCORE_WEIGHTS
+from cost import Coefficients, coefficient_vector, in_range, nutrition_vector
+from item_choice import section_categories
+from lattice import BLOCK_ELEMENTS, DEFAULT_GRID_SIZE, lattice_totals, triple_arrays
+from portion import DEFAULT_COEFFICIENTS, MealItemSpec
+from requirements import nutritional_info_for, StudentProfileSpec
+
+# Max number of triples sampled per (menu, plate layout)
+DEFAULT_MAX_TRIPLES = 2000
+# Successive halving: fraction of the triples the first round is evaluated on, and the factor by which the number of
+# configurations is divided (and the fraction multiplied) at each round
+DEFAULT_MIN_FRACTION = 1 / 9
+DEFAULT_ETA = 3
+
+
+def grid_space(space: dict, base: Coefficients = DEFAULT_COEFFICIENTS) -> list[dict]:
+    """
+    @param space: dict of nutrient -> list of coefficient values to try
+    @param base: Coefficients of the nutrients that are not in space
+    @return: Every combination of the values, as dicts of nutrient -> coefficient (see cost.coefficient_vector)
+    """
+    base = dict(zip(NUTRITION_FIELDS, coefficient_vector(base).tolist()))
+    return [dict(base, **dict(zip(space, values))) for values in itertools.product(*space.values())]
+
+
+def random_space(space: dict, n: int, seed: int, base: Coefficients = DEFAULT_COEFFICIENTS) -> list[dict]:
+    """
+    @param space: dict of nutrient -> (lo, hi) range of coefficient values.  Values are sampled log-uniformly if lo > 0,
+    uniformly otherwise
+    @param n: Number of configurations
+    @param seed: RNG seed
+    @param base: Coefficients of the nutrients that are not in space
+    @return: The sampled configurations, as dicts of nutrient -> coefficient
+    """
+    rng = random.Random(seed)
+    base = dict(zip(NUTRITION_FIELDS, coefficient_vector(base).tolist()))
+
+    def sample(lo, hi):
+        return math.exp(rng.uniform(math.log(lo), math.log(hi))) if lo > 0 else rng.uniform(lo, hi)
+
+    return [dict(base, **{name: sample(*bounds) for name, bounds in space.items()}) for _ in range(n)]
+
+
+# Plate arrays and requirements of the sweep, and the lattice size, set once per worker process by _init_worker
+_blocks = []
+_grid_size = DEFAULT_GRID_SIZE
+
+
+def _init_worker(blocks: list, grid_size: int):
+    global _blocks, _grid_size
+    _blocks = blocks
+    _grid_size = grid_size
+
+
+def _evaluate(coefficients: dict, fraction: float):
+    """
+    Portions every sampled triple for every student at the given coefficients (minimizing the cost over the volume
+    lattice), and checks which nutrients end up in range.  Lattice totals are computed block by block, which is cheap
+    next to evaluating them for every student, so a worker never holds more than BLOCK_ELEMENTS of them
+    @param coefficients: The configuration
+    @param fraction: Fraction of the sampled triples to evaluate (the first ones, they are in random order)
+    @return: ((16,) number of portioned plates with each nutrient in range, number of portioned plates)
+    """
+    weights = coefficient_vector(coefficients)
+    # Nutrients with a 0 coefficient don't change the cost, so it is only evaluated on the others
+    active = weights != 0
+    counts = np.zeros(len(NUTRITION_FIELDS), dtype=np.int64)
+    num_plates = 0
+    num_points = _grid_size ** 3
+    for arrays, lo, hi in _blocks:
+        n = math.ceil(fraction * len(arrays[0]))
+        step = max(1, BLOCK_ELEMENTS // (len(lo) * num_points * int(active.sum())))
+        for start in range(0, n, step):
+            block = lattice_totals(*(a[start:min(start + step, n)] for a in arrays), _grid_size)
+            # (block, P, lattice): cost of each lattice point of each triple for each student
+            sub = block[:, None, :, active]
+            dist = np.maximum(lo[None, :, None, active] - sub, 0) + np.maximum(sub - hi[None, :, None, active], 0)
+            best = ((dist ** 2) @ weights[active]).argmin(axis=2)
+            chosen = np.take_along_axis(block[:, None], best[:, :, None, None], axis=2)[:, :, 0]
+            counts += in_range(chosen, lo[None], hi[None]).sum(axis=(0, 1))
+            num_plates += best.size
+    return counts, num_plates
+
+
+class CoefficientSweep:
+    def __init__(self, profiles: list[StudentProfileSpec], menus: list[list[MealItemSpec]],
+                 large_portion_max: float, small_portion_max: float, grid_size: int = DEFAULT_GRID_SIZE,
+                 max_triples: int = DEFAULT_MAX_TRIPLES, seed: int = 0, max_workers: Optional[int] = None):
+        """
+        Evaluates coefficient configurations by how often each nutrient of the portioned plates ends up in range, as in
+        the weight_experiment/ tables and Analysis.ipynb.  Every triple of every menu (up to max_triples random ones per
+        menu) is portioned for every student by minimizing the cost over a lattice of section volumes (see
+        lattice.py).  The triples and requirements are prepared once and shared with the worker processes, which only
+        evaluate the cost per configuration.
+        @param profiles: The student cohort
+        @param menus: Lists of items available at a meal
+        @param large_portion_max: Size of the large plate section (mL)
+        @param small_portion_max: Size of the small plate sections (mL)
+        @param grid_size: Number of volumes tried per plate section
+        @param max_triples: Max number of triples sampled per menu and plate layout
+        @param seed: RNG seed of the triple sampling
+        @param max_workers: Size of the process pool, defaults to the number of CPUs
+        """
+        self.profiles = profiles
+        self.menus = menus
+        self.large_portion_max = large_portion_max
+        self.small_portion_max = small_portion_max
+        self.grid_size = grid_size
+        self.max_triples = max_triples
+        self.seed = seed
+        self.max_workers = max_workers
+
+        self._prepared = None
+        self.results = []
+        self.runtime = -1
+
+    def _blocks(self) -> list:
+        """
+        @return: One (triple_arrays of T triples, lo (P, 16), hi (P, 16)) block per (menu, plate layout), with the
+        students having that layout.  Computed on the first call
+        """
+        if self._prepared is not None:
+            return self._prepared
+        rng = random.Random(self.seed)
+        by_layout = defaultdict(list)
+        for profile in self.profiles:
+            by_layout[section_categories(profile.health_goal, self.large_portion_max)].append(profile)
+
+        blocks = []
+        volumes = self.large_portion_max, self.small_portion_max, self.small_portion_max
+        for menu in self.menus:
+            for layout, profiles in by_layout.items():
+                sections = [[item for item in menu if item.category == category] for category in layout]
+                triples = list(itertools.product(*sections))
+                rng.shuffle(triples)
+                triples = triples[:self.max_triples]
+                if not triples:
+                    continue
+                lo, hi = (np.array([nutrition_vector(nutritional_info_for(profile)[side]) for profile in profiles])
+                          for side in (0, 1))
+                blocks.append((triple_arrays(triples, volumes), lo, hi))
+        self._prepared = blocks
+        return blocks
+
+    def run(self, configs: list[Coefficients], min_fraction: float = DEFAULT_MIN_FRACTION, eta: int = DEFAULT_ETA):
+        """
+        Evaluates the configurations with successive halving: every configuration is first evaluated on min_fraction
+        of the triples, then only the best 1 / eta of them (by mean plate score, see common.SCORE_WEIGHTS) go on to be
+        evaluated on eta times more triples, until the remaining ones are evaluated on all of them
+        @param configs: Coefficient configurations, e.g. from grid_space or random_space.  Each needs at least one
+        non-zero coefficient
+        @param min_fraction: Fraction of the triples of the first round, 1 to evaluate everything on all triples
+        @param eta: Halving factor
+        @return: None, one dict per configuration is available in self.results, best first.  Each holds the
+        configuration ('coefficients', in NUTRITION_FIELDS order), the fraction of the triples it was last evaluated on
+        ('fraction'), the mean plate score ('score') and the in-range ratio of each nutrient ('in_range')
+        """
+        start_time = time.perf_counter()
+        configs = [dict(zip(NUTRITION_FIELDS, coefficient_vector(config).tolist())) for config in configs]
+        for idx, config in enumerate(configs):
+            if not any(config.values()):
+                raise ValueError(f'Configuration {idx} has no non-zero coefficient')
+        score_weights = np.array(SCORE_WEIGHTS)
+        results = [None] * len(configs)
+        alive = list(range(len(configs)))
+        fraction = min(1., min_fraction)
+
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                 initargs=(self._blocks(), self.grid_size)) as pool:
+            while alive:
+                for idx, (counts, num_plates) in zip(alive, pool.map(_evaluate, (configs[idx] for idx in alive),
+                                                                      itertools.repeat(fraction))):
+                    ratios = counts / max(1, num_plates)
+                    results[idx] = dict(coefficients=configs[idx], fraction=fraction,
+                                        score=float(ratios @ score_weights),
+                                        in_range=dict(zip(NUTRITION_FIELDS, ratios.tolist())))
+                if fraction >= 1 or len(alive) <= 1:
+                    break
+                alive = sorted(alive, key=lambda idx: -results[idx]['score'])[:math.ceil(len(alive) / eta)]
+                fraction = min(1., fraction * eta)
+
+        self.results = sorted(results, key=lambda result: (-result['fraction'], -result['score']))
+        self.runtime = time.perf_counter() - start_time
+
+    def save_csv(self, path: str):
+        """
+        Writes one row per configuration: its coefficients, evaluated fraction, score and per-nutrient in-range ratios
+        (as <nutrient>_in_range columns)
+        @param path: Output path
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(NUTRITION_FIELDS) + ['fraction', 'score'] +
+                            [f'{name}_in_range' for name in NUTRITION_FIELDS])
+            for result in self.results:
+                writer.writerow([result['coefficients'][name] for name in NUTRITION_FIELDS] +
+                                [result['fraction'], result['score']] +
+                                [result['in_range'][name] for name in NUTRITION_FIELDS])
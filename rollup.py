@@ -0,0 +1,158 @@
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from generate_menu_test.common import CAL_WEIGHT, MACRO_NUTRIENTS, MACRO_WEIGHT, MICRO_NUTRIENTS, MICRO_WEIGHT, \
+    VALID_COMBINATION_SCORE
+
+SUMMARY_PATH = 'female_male_summary_fixed_1.csv'
+
+# Dimensions of the cube: menu, meal category (first word of the menu name), and the student traits
+KEY = ['Name', 'category', 'Sex', 'Health_Goal', 'Activity']
+
+# Delta columns of the combination score (see generate_menu_test.common)
+LABEL_MACRO = [f'{name}_delta' for name in MACRO_NUTRIENTS]
+LABEL_MICRO = [f'{name}_delta' for name in MICRO_NUTRIENTS]
+
+# Rows read at a time by RollupCube.from_csv
+CHUNK_SIZE = 500_000
+
+
+def prepare(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the derived columns of Analysis.ipynb to summary rows: 'category', 'score' and 'is_valid'
+    @param df: Rows of the summary CSV
+    @return: Copy of df with the new columns
+    """
+    df = df.copy()
+    df['category'] = df['Name'].str.split().str[0].str.lower()
+    df['score'] = df['calories_delta'].isna() * CAL_WEIGHT + \
+        df[LABEL_MACRO].isna().sum(axis=1) * MACRO_WEIGHT + \
+        df[LABEL_MICRO].isna().sum(axis=1) * MICRO_WEIGHT
+    df['is_valid'] = df['score'] >= VALID_COMBINATION_SCORE
+    return df
+
+
+class RollupCube:
+    def __init__(self):
+        """
+        Precomputed aggregates of the summary table (one row per student x menu x combination), keyed by KEY.  Only
+        additive counts are stored, so the cube can be updated with new rows at any time and rolled up to any subset of
+        KEY.  There are three tables:
+        * combinations: KEY -> number of rows ('rows'), valid rows ('is_valid') and summed score ('score')
+        * nutrients: KEY + nutrient -> number of rows where the nutrient is out of range ('out_of_range'), above it
+          ('above') and below it ('below')
+        * menus: Name -> category and Num_Unique_Combinations
+        """
+        self.combinations = pd.DataFrame(columns=['rows', 'is_valid', 'score'],
+                                         index=pd.MultiIndex.from_tuples([], names=KEY))
+        self.nutrients = pd.DataFrame(columns=['out_of_range', 'above', 'below'],
+                                      index=pd.MultiIndex.from_tuples([], names=KEY + ['nutrient']))
+        self.menus = pd.DataFrame(columns=['category', 'Num_Unique_Combinations'], index=pd.Index([], name='Name'))
+
+    @classmethod
+    def from_csv(cls, path: str = SUMMARY_PATH, chunk_size: int = CHUNK_SIZE) -> 'RollupCube':
+        """
+        Builds the cube from a summary CSV, reading it in chunks
+        @param path: Path to the CSV
+        @param chunk_size: Rows per chunk
+        @return: The cube
+        """
+        cube = cls()
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            cube.update(chunk)
+        return cube
+
+    def update(self, df: pd.DataFrame):
+        """
+        Adds summary rows to the cube
+        @param df: New rows of the summary table (raw, or already through prepare)
+        @return: None
+        """
+        if 'is_valid' not in df.columns:
+            df = prepare(df)
+        label_delta = [label for label in df.columns if label.endswith('_delta')]
+        nutrients = [label[:-len('_delta')] for label in label_delta]
+        deltas = df[label_delta]
+
+        # One boolean column per (measure, nutrient), summed per key in a single groupby, then stacked into long form
+        flags = pd.concat({
+            'out_of_range': deltas.notna(),
+            'above': deltas > 0,
+            'below': deltas < 0,
+        }, axis=1).astype('int64')
+        flags.columns = pd.MultiIndex.from_tuples([(measure, label[:-len('_delta')]) for measure, label in flags.columns],
+                                                  names=[None, 'nutrient'])
+        grouped = flags.groupby([df[column] for column in KEY], dropna=False).sum()
+        new_nutrients = grouped.stack('nutrient', future_stack=True).reindex(nutrients, level='nutrient')
+
+        new_combinations = df.assign(rows=1).groupby(KEY, dropna=False)[['rows', 'is_valid', 'score']].sum()
+
+        self.combinations = new_combinations.add(self.combinations, fill_value=0).astype(
+            {'rows': 'int64', 'is_valid': 'int64', 'score': 'float64'})
+        self.nutrients = new_nutrients[['out_of_range', 'above', 'below']].add(
+            self.nutrients, fill_value=0).astype('int64')
+        menus = df[['Name', 'category', 'Num_Unique_Combinations']].drop_duplicates('Name').set_index('Name')
+        self.menus = pd.concat((self.menus, menus[~menus.index.isin(self.menus.index)]))
+
+    @staticmethod
+    def _filter(table: pd.DataFrame, filters: dict) -> pd.DataFrame:
+        """
+        @param filters: dict of KEY column -> value or list of values to keep
+        """
+        mask = pd.Series(True, index=table.index)
+        for column, value in filters.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            mask &= table.index.get_level_values(column).isin(values)
+        return table[mask.values]
+
+    def valid_counts(self, by: Iterable[str] = ('Name',), **filters) -> pd.DataFrame:
+        """
+        Number of combinations and valid combinations (the notebook's groupby('Name').sum() of is_valid)
+        @param by: KEY columns to group by
+        @param filters: KEY column -> value(s) to restrict to, e.g. category='lunch'
+        @return: DataFrame indexed by the by columns, with 'rows', 'is_valid' and mean 'score' columns
+        """
+        table = self._filter(self.combinations, filters).groupby(list(by), dropna=False).sum()
+        table['score'] = table['score'] / table['rows']
+        return table
+
+    def out_of_range(self, by: Iterable[str] = (), **filters) -> pd.DataFrame:
+        """
+        Share of combinations where each nutrient is out of range, above it and below it
+        @param by: KEY columns to group by (in addition to the nutrient)
+        @param filters: KEY column -> value(s) to restrict to, e.g. Sex='FEMALE'
+        @return: DataFrame indexed by the by columns and the nutrient, with 'out_of_range', 'above' and 'below' ratios
+        """
+        by = list(by)
+        counts = self._filter(self.nutrients, filters).groupby(by + ['nutrient'], dropna=False, sort=False).sum()
+        rows = self._filter(self.combinations, filters)['rows']
+        rows = rows.groupby(by, dropna=False).sum() if by else rows.sum()
+        if by:
+            return counts.div(rows.reindex(counts.index.droplevel('nutrient')).values, axis=0)
+        return counts / rows
+
+    def unique_combinations_mean(self, by: Optional[str] = 'category') -> pd.Series:
+        """
+        @param by: Menu column to average by, None for the overall mean
+        @return: Mean Num_Unique_Combinations of the menus
+        """
+        values = self.menus['Num_Unique_Combinations'].astype(float)
+        return values.groupby(self.menus[by]).mean() if by else values.mean()
+
+    def save(self, path: str):
+        """
+        Saves the cube (a pickle of its tables)
+        @param path: Output path
+        """
+        pd.to_pickle((self.combinations, self.nutrients, self.menus), path)
+
+    @classmethod
+    def load(cls, path: str) -> 'RollupCube':
+        """
+        @param path: Path of a cube written by save
+        @return: The cube
+        """
+        cube = cls()
+        cube.combinations, cube.nutrients, cube.menus = pd.read_pickle(path)
+        return cube